@@ -0,0 +1,130 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+CACHE_DIR = os.getenv("SHORTROCITY_CACHE_DIR", os.path.join("cache", "assets"))
+MAX_CACHE_BYTES = int(os.getenv("SHORTROCITY_CACHE_MAX_BYTES", 2 * 1024**3))
+
+
+class AssetCache:
+    def __init__(self, root=CACHE_DIR, max_bytes=MAX_CACHE_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.index_file = os.path.join(root, "index.json")
+        self.hits = 0
+        self.misses = 0
+        self.entries = None
+        self.total = 0
+        self.lock = threading.Lock()
+
+    def key(self, provider, model, params, input):
+        payload = json.dumps(
+            {"provider": provider, "model": model, "params": params, "input": input},
+            sort_keys=True,
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def fetch(self, key, output_file):
+        path = self.path(key)
+        if not os.path.exists(path):
+            with self.lock:
+                self.misses += 1
+            return False
+
+        link_or_copy(path, output_file)
+
+        # Last use is kept in the index rather than the file's mtime, since
+        # the entry's inode is shared with every short that links it
+        with self.lock:
+            self.hits += 1
+            self._load_index()
+            self.entries[key] = {"size": os.path.getsize(path), "used": time.time()}
+            self._save_index()
+        return True
+
+    def store(self, key, source_file):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        shutil.copyfile(source_file, temp_path)
+        os.replace(temp_path, path)
+
+        with self.lock:
+            self._load_index()
+            previous = self.entries.get(key)
+            if previous is not None:
+                self.total -= previous["size"]
+            self.entries[key] = {"size": os.path.getsize(path), "used": time.time()}
+            self.total += self.entries[key]["size"]
+            self._evict()
+            self._save_index()
+
+    def evict(self):
+        with self.lock:
+            self._load_index()
+            self._evict()
+            self._save_index()
+
+    def _evict(self):
+        # Drop the least recently used entries until we fit the budget
+        for key in sorted(self.entries, key=lambda k: self.entries[k]["used"]):
+            if self.total <= self.max_bytes:
+                break
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+            self.total -= self.entries.pop(key)["size"]
+
+    def _load_index(self):
+        if self.entries is not None:
+            return
+
+        if os.path.exists(self.index_file):
+            with open(self.index_file) as f:
+                self.entries = json.load(f)
+        else:
+            # Caches written before the index existed are scanned once
+            self.entries = {}
+            for dirpath, _, filenames in os.walk(self.root):
+                for filename in filenames:
+                    if filename.endswith(".tmp") or filename == "index.json":
+                        continue
+                    stat = os.stat(os.path.join(dirpath, filename))
+                    self.entries[filename] = {
+                        "size": stat.st_size,
+                        "used": stat.st_mtime,
+                    }
+
+        self.total = sum(entry["size"] for entry in self.entries.values())
+
+    def _save_index(self):
+        os.makedirs(self.root, exist_ok=True)
+        temp_path = f"{self.index_file}.{threading.get_ident()}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self.entries, f)
+        os.replace(temp_path, self.index_file)
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+
+def link_or_copy(source_file, output_file):
+    if os.path.exists(output_file):
+        os.remove(output_file)
+    try:
+        os.link(source_file, output_file)
+    except OSError:
+        shutil.copyfile(source_file, output_file)
+
+
+default_cache = AssetCache()
@@ -0,0 +1,164 @@
+import argparse
+import json
+import os
+import threading
+import time
+
+import metrics
+
+MANIFEST_FILE = "audio_manifest.json"
+LOUDNORM_TARGET = "I=-14:TP=-2:LRA=11"
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def probe(audio_file):
+    ffprobe_command = [
+        "ffprobe",
+        "-v",
+        "error",
+        "-select_streams",
+        "a:0",
+        "-show_entries",
+        "format=duration:stream=sample_rate",
+        "-of",
+        "json",
+        audio_file,
+    ]
+
+    result = metrics.run(
+        ffprobe_command, name="ffprobe", capture_output=True, check=True
+    )
+    info = json.loads(result.stdout)
+
+    return {
+        "duration_ms": float(info["format"]["duration"]) * 1000,
+        "sample_rate": int(info["streams"][0]["sample_rate"]),
+    }
+
+
+def measure_loudness(audio_file):
+    # First pass of two-pass loudnorm, the measurements are printed as JSON
+    ffmpeg_command = [
+        "ffmpeg",
+        "-hide_banner",
+        "-nostats",
+        "-i",
+        audio_file,
+        "-af",
+        f"loudnorm={LOUDNORM_TARGET}:print_format=json",
+        "-f",
+        "null",
+        "-",
+    ]
+
+    result = metrics.run(
+        ffmpeg_command, name="ffmpeg.loudness", capture_output=True, check=True
+    )
+    stderr = result.stderr.decode("utf-8", errors="replace")
+    return json.loads(stderr[stderr.rindex("{") : stderr.rindex("}") + 1])
+
+
+class AudioIndex:
+    def __init__(self, basedir):
+        self.basedir = basedir
+        self.path = os.path.join(basedir, MANIFEST_FILE)
+        self.lock = threading.Lock()
+        self.entries = {}
+
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.entries = json.load(f)
+
+    def get(self, audio_file):
+        key = os.path.relpath(audio_file, self.basedir)
+        stat = os.stat(audio_file)
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if (
+                entry is not None
+                and entry["size"] == stat.st_size
+                and entry["mtime"] == stat.st_mtime
+            ):
+                return entry
+
+        # Only probe clips that are new or have changed since the last run
+        entry = probe(audio_file)
+        entry["size"] = stat.st_size
+        entry["mtime"] = stat.st_mtime
+
+        with self.lock:
+            self.entries[key] = entry
+            self.save()
+
+        return entry
+
+    def duration_ms(self, audio_file):
+        return self.get(audio_file)["duration_ms"]
+
+    def sample_rate(self, audio_file):
+        return self.get(audio_file)["sample_rate"]
+
+    def loudness(self, audio_file):
+        entry = self.get(audio_file)
+        if "loudness" in entry:
+            return entry["loudness"]
+
+        loudness = measure_loudness(audio_file)
+
+        with self.lock:
+            entry["loudness"] = loudness
+            self.save()
+
+        return loudness
+
+    def save(self):
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self.entries, f, indent=2)
+        os.replace(temp_path, self.path)
+
+
+def load(basedir):
+    key = os.path.abspath(basedir)
+    with _indexes_lock:
+        if key not in _indexes:
+            _indexes[key] = AudioIndex(basedir)
+        return _indexes[key]
+
+
+if __name__ == "__main__":
+    from pydub import AudioSegment
+
+    parser = argparse.ArgumentParser(
+        description="Compare full MP3 decodes with the audio manifest."
+    )
+    parser.add_argument("basedir", type=str)
+    args = parser.parse_args()
+
+    narrations_dir = os.path.join(args.basedir, "narrations")
+    audio_files = sorted(
+        os.path.join(narrations_dir, f)
+        for f in os.listdir(narrations_dir)
+        if f.endswith(".mp3")
+    )
+
+    start = time.perf_counter()
+    for audio_file in audio_files:
+        len(AudioSegment.from_file(audio_file))
+    decode_time = time.perf_counter() - start
+
+    index = load(args.basedir)
+    for audio_file in audio_files:
+        index.get(audio_file)
+
+    start = time.perf_counter()
+    for audio_file in audio_files:
+        index.duration_ms(audio_file)
+    index_time = time.perf_counter() - start
+
+    print(f"{len(audio_files)} clips")
+    print(f"pydub decode: {decode_time * 1000:.1f} ms")
+    print(f"manifest lookup: {index_time * 1000:.3f} ms")
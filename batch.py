@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import multiprocessing
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import main
+import upload
+import utils
+
+
+def load_jobs(jobs_file):
+    jobs = []
+    with open(jobs_file) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                jobs.append(json.loads(line))
+    return jobs
+
+
+def run_job(index, job, batch_id, render_executor, credentials, args):
+    if not job.get("user_prompt") and not job.get("animal"):
+        raise ValueError("No unused animal left for this job")
+
+    with open(job["system_prompt"]) as f:
+        system_prompt = f.read()
+
+    # Caption settings can be given inline or as a path to a JSON file
+    caption_settings = job.get("caption_settings") or {}
+    if isinstance(caption_settings, str):
+        with open(caption_settings) as f:
+            caption_settings = json.load(f)
+
+    return main.main(
+        system_prompt,
+        job.get("user_prompt"),
+        caption_settings,
+        job.get("image_svc", "dall_e"),
+        image_concurrency=args.image_concurrency,
+        image_fallback_svc=job.get("image_fallback_svc", args.image_fallback_svc),
+        render_backend=job.get("render_backend", args.render_backend),
+        single_pass=job.get("single_pass", args.single_pass),
+        short_id=f"{batch_id}_{index}",
+        render_executor=render_executor,
+        metrics_prom=args.metrics_prom,
+        use_llm_cache=not args.no_llm_cache,
+        youtube_credentials=credentials,
+        animal=job.get("animal"),
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Produce one short per line of a JSONL jobs file."
+    )
+    parser.add_argument("--jobs_file", type=str, required=True)
+    parser.add_argument(
+        "--results_file",
+        type=str,
+        default="batch_results.jsonl",
+        help="Where to append one result record per job",
+    )
+    parser.add_argument(
+        "--api_workers",
+        type=int,
+        default=16,
+        help="Number of jobs whose API-bound stages run at the same time",
+    )
+    parser.add_argument(
+        "--render_workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of processes for rendering and transcription",
+    )
+    parser.add_argument("--image_concurrency", type=int, required=False)
+    parser.add_argument(
+        "--image_fallback_svc",
+        choices=["dall_e", "flux_schnell", "flux_pro"],
+        required=False,
+        type=str,
+        help="Hedge slow image requests with this service",
+    )
+    parser.add_argument(
+        "--render_backend",
+        choices=["opencv", "ffmpeg", "chunked"],
+        default="opencv",
+        type=str,
+    )
+    parser.add_argument("--single_pass", action="store_true")
+    parser.add_argument(
+        "--no_llm_cache",
+        action="store_true",
+        help="Always call the model instead of reusing cached responses",
+    )
+    parser.add_argument(
+        "--metrics_prom",
+        type=str,
+        required=False,
+        help="Prometheus textfile with span latency histograms for the batch",
+    )
+    args = parser.parse_args()
+
+    jobs = load_jobs(args.jobs_file)
+    batch_id = str(int(time.time()))
+
+    # Authenticate once up front and share the credentials, so job threads
+    # never refresh and rewrite token.pickle at the same time
+    credentials = upload.get_credentials()
+
+    # Jobs without a prompt get their animal here rather than each picking
+    # one, since the titles index only learns about a topic once its short
+    # is uploaded and parallel jobs would pick the same animals
+    unassigned = [
+        job for job in jobs if not job.get("user_prompt") and not job.get("animal")
+    ]
+    if unassigned:
+        youtube = upload.get_authenticated_service(credentials)
+        chosen = [job["animal"] for job in jobs if job.get("animal")]
+        animals = utils.pick_random_animals(
+            "animals.txt", youtube, len(unassigned), exclude=chosen
+        )
+        if len(animals) < len(unassigned):
+            print(
+                f"Only {len(animals)} unused animals left, "
+                f"{len(unassigned) - len(animals)} jobs will fail"
+            )
+        for job, animal in zip(unassigned, animals):
+            job["animal"] = animal
+
+    results_lock = threading.Lock()
+
+    def record(index, job, start, result=None, error=None):
+        entry = {
+            "job": index,
+            "short_id": f"{batch_id}_{index}",
+            "user_prompt": job.get("user_prompt"),
+            "animal": job.get("animal"),
+            "image_svc": job.get("image_svc", "dall_e"),
+            "status": "ok" if error is None else "failed",
+            "uploaded": result["uploaded"] if result else False,
+            "elapsed": round(time.time() - start, 2),
+            "error": error,
+        }
+        with results_lock:
+            with open(args.results_file, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+
+    def process(index, job):
+        start = time.time()
+        try:
+            result = run_job(index, job, batch_id, render_executor, credentials, args)
+        except Exception as e:
+            traceback.print_exc()
+            record(index, job, start, error=str(e))
+            return False
+        record(index, job, start, result=result)
+        return True
+
+    # Forking while job threads hold locks or sockets can deadlock the
+    # workers, so they are started from a fresh interpreter instead
+    with ProcessPoolExecutor(
+        max_workers=args.render_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+    ) as render_executor:
+        with ThreadPoolExecutor(max_workers=args.api_workers) as executor:
+            outcomes = list(executor.map(process, range(len(jobs)), jobs))
+
+    print(
+        f"DONE! {sum(outcomes)} of {len(jobs)} jobs succeeded, see {args.results_file}"
+    )
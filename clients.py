@@ -0,0 +1,86 @@
+import os
+import threading
+
+import dotenv
+import httpx
+import replicate
+import requests
+from openai import OpenAI
+from requests.adapters import HTTPAdapter
+
+dotenv.load_dotenv()
+
+CONNECT_TIMEOUT = 10  # seconds
+READ_TIMEOUT = 120  # seconds
+POOL_SIZE = 32
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+_lock = threading.Lock()
+_openai_client = None
+_replicate_client = None
+_http_session = None
+
+
+def get_openai_client():
+    global _openai_client
+
+    # One client (and one keep-alive connection pool) for every OpenAI call
+    with _lock:
+        if _openai_client is None:
+            _openai_client = OpenAI(
+                api_key=os.getenv("OPENAI_API_KEY"),
+                timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT),
+                http_client=httpx.Client(
+                    limits=httpx.Limits(
+                        max_connections=POOL_SIZE,
+                        max_keepalive_connections=POOL_SIZE,
+                    )
+                ),
+            )
+        return _openai_client
+
+
+def get_replicate_client():
+    global _replicate_client
+
+    with _lock:
+        if _replicate_client is None:
+            _replicate_client = replicate.Client(
+                api_token=os.getenv("REPLICATE_API_TOKEN"),
+                timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT),
+                limits=httpx.Limits(
+                    max_connections=POOL_SIZE,
+                    max_keepalive_connections=POOL_SIZE,
+                ),
+            )
+        return _replicate_client
+
+
+def get_http_session():
+    global _http_session
+
+    with _lock:
+        if _http_session is None:
+            adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+            _http_session = requests.Session()
+            _http_session.mount("https://", adapter)
+            _http_session.mount("http://", adapter)
+        return _http_session
+
+
+def download_to_file(url, output_file):
+    session = get_http_session()
+
+    # Write the body in chunks as it arrives instead of buffering it, into
+    # a new file so a cache entry linked at output_file is left alone
+    with session.get(
+        url, stream=True, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)
+    ) as response:
+        response.raise_for_status()
+
+        temp_file = f"{output_file}.part"
+        with open(temp_file, "wb") as f:
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+
+    os.replace(temp_file, output_file)
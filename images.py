@@ -1,32 +1,199 @@
 import argparse
 import base64
+import functools
+import json
 import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 import dotenv
-import replicate
-import requests
-from openai import OpenAI
+
+import asset_cache
+import clients
+import metrics
+import ratelimit
 
 dotenv.load_dotenv()
 
+# Maximum number of in-flight requests per image service
+MAX_CONCURRENCY = {
+    "dall_e": 5,
+    "flux_schnell": 8,
+    "flux_pro": 4,
+}
+
+# Account whose rate limit each image service counts against
+PROVIDERS = {
+    "dall_e": "openai",
+    "flux_schnell": "replicate",
+    "flux_pro": "replicate",
+}
+
+# Seconds to wait for the primary service before also asking the fallback
+HEDGE_AFTER = 30
+
+# Model and parameters that identify an image in the asset cache
+IMAGE_MODELS = {
+    "dall_e": ("dall-e-3", {"size": "1024x1792", "quality": "standard"}),
+    "flux_schnell": (
+        "black-forest-labs/flux-schnell",
+        {"aspect_ratio": "9:16", "output_quality": 80, "num_inference_steps": 4},
+    ),
+    "flux_pro": (
+        "black-forest-labs/flux-1.1-pro",
+        {"aspect_ratio": "9:16", "output_quality": 80, "num_inference_steps": 4},
+    ),
+}
+
 
-def create_images_from_data(data, output_dir, image_svc) -> None:
+def create_images_from_data(
+    data,
+    output_dir,
+    image_svc,
+    concurrency=None,
+    fallback_svc=None,
+    hedge_after=HEDGE_AFTER,
+) -> None:
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
+    jobs = []
     image_number = 0
     for element in data:
         if element["type"] != "image":
             continue
         image_number += 1
         image_name = f"image_{image_number}.webp"
-        prompt = element["description"] + ". Vertical image, fully filling the canvas."
-        create_image_from_prompt(
-            prompt, os.path.join(output_dir, image_name), image_svc
+        jobs.append((get_prompt(element), os.path.join(output_dir, image_name)))
+
+    if not jobs:
+        return
+
+    if concurrency is None:
+        concurrency = MAX_CONCURRENCY.get(image_svc, 1)
+    concurrency = max(1, min(concurrency, len(jobs)))
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [
+            metrics.submit(
+                executor,
+                create_image_from_prompt,
+                prompt,
+                output_file,
+                image_svc,
+                fallback_svc=fallback_svc,
+                hedge_after=hedge_after,
+            )
+            for prompt, output_file in jobs
+        ]
+
+    # Wait for every prompt before reporting, so one failure doesn't
+    # abandon the images that are still being generated
+    failed = []
+    for (prompt, output_file), future in zip(jobs, futures):
+        error = future.exception()
+        if error is not None:
+            print(f"Failed to generate {os.path.basename(output_file)}: {error}")
+            failed.append(os.path.basename(output_file))
+
+    if failed:
+        raise RuntimeError(f"Failed to generate images: {', '.join(failed)}")
+
+
+def get_prompt(element):
+    return element["description"] + ". Vertical image, fully filling the canvas."
+
+
+def create_image_from_prompt(
+    prompt,
+    output_file,
+    image_svc,
+    cache=asset_cache.default_cache,
+    fallback_svc=None,
+    hedge_after=HEDGE_AFTER,
+):
+    services = [image_svc] if fallback_svc is None else [image_svc, fallback_svc]
+    for svc in services:
+        if svc not in IMAGE_MODELS:
+            raise ValueError(f"Unknown image service: {svc}")
+
+    with metrics.span(
+        "image", file=os.path.basename(output_file), image_svc=image_svc
+    ) as span:
+        cache_keys = {}
+        if cache is not None:
+            for svc in services:
+                model, params = IMAGE_MODELS[svc]
+                cache_keys[svc] = cache.key(svc, model, params, prompt)
+                span["attributes"]["cache_hit"] = cache.fetch(
+                    cache_keys[svc], output_file
+                )
+                if span["attributes"]["cache_hit"]:
+                    return
+
+        if fallback_svc is None:
+            winner = image_svc
+            generate_with_retries(prompt, output_file, image_svc)
+        else:
+            winner = generate_hedged(
+                prompt, output_file, image_svc, fallback_svc, hedge_after
+            )
+            span["attributes"]["winner"] = winner
+
+        # Cache under the service that actually produced the image
+        if cache is not None:
+            cache.store(cache_keys[winner], output_file)
+
+
+def generate_with_retries(prompt, output_file, image_svc):
+    ratelimit.call(PROVIDERS[image_svc], generate_image, prompt, output_file, image_svc)
+
+
+def generate_hedged(prompt, output_file, image_svc, fallback_svc, hedge_after):
+    executor = ThreadPoolExecutor(max_workers=2)
+    temp_files = {}
+    futures = {}
+
+    def start(svc):
+        temp_files[svc] = f"{output_file}.{svc}.tmp"
+        future = metrics.submit(
+            executor, generate_with_retries, prompt, temp_files[svc], svc
         )
+        futures[future] = svc
+
+    try:
+        start(image_svc)
+        done, _ = wait(futures, timeout=hedge_after)
+
+        # A failed primary also falls through to the fallback service
+        if not done or next(iter(done)).exception() is not None:
+            print(f"Hedging {os.path.basename(output_file)} with {fallback_svc}")
+            start(fallback_svc)
+
+        pending = set(futures)
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    winner = futures[future]
+                    os.replace(temp_files[winner], output_file)
+                    return winner
+                error = future.exception()
+        raise error
+    finally:
+        # The losing request can't be interrupted, so let it finish in the
+        # background and throw its image away
+        for future, svc in futures.items():
+            future.add_done_callback(functools.partial(_discard, temp_files[svc]))
+        executor.shutdown(wait=False)
+
 
+def _discard(path, future):
+    if os.path.exists(path):
+        os.remove(path)
 
-def create_image_from_prompt(prompt, output_file, image_svc):
+
+def generate_image(prompt, output_file, image_svc):
     if image_svc == "dall_e":
         image_b64 = generate_using_dall_e(prompt)
         save_image_from_dall_e_b64(image_b64, output_file)
@@ -41,7 +208,8 @@ def create_image_from_prompt(prompt, output_file, image_svc):
 
 
 def generate_using_dall_e(prompt, size="1024x1792"):
-    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    # ratelimit.call is the only retry policy, so it sees every 429
+    client = clients.get_openai_client().with_options(max_retries=0)
     response = client.images.generate(
         model="dall-e-3",
         prompt=prompt,
@@ -54,12 +222,15 @@ def generate_using_dall_e(prompt, size="1024x1792"):
 
 
 def save_image_from_dall_e_b64(image_b64, output_file) -> None:
-    with open(output_file, "wb") as f:
+    # Replace rather than overwrite, the old file may be linked from the cache
+    temp_file = f"{output_file}.part"
+    with open(temp_file, "wb") as f:
         f.write(base64.b64decode(image_b64))
+    os.replace(temp_file, output_file)
 
 
 def generate_using_flux_schnell(prompt: str, aspect_ratio="9:16") -> str:
-    output = replicate.run(
+    output = clients.get_replicate_client().run(
         "black-forest-labs/flux-schnell",
         input={
             "prompt": prompt,
@@ -75,7 +246,7 @@ def generate_using_flux_schnell(prompt: str, aspect_ratio="9:16") -> str:
 
 
 def generate_using_flux_pro(prompt: str, aspect_ratio="9:16") -> str:
-    output = replicate.run(
+    output = clients.get_replicate_client().run(
         "black-forest-labs/flux-1.1-pro",
         input={
             "prompt": prompt,
@@ -90,20 +261,67 @@ def generate_using_flux_pro(prompt: str, aspect_ratio="9:16") -> str:
 
 
 def save_image_from_flux_url(url, output_file):
-    response = requests.get(url)
-    with open(output_file, "wb") as f:
-        f.write(response.content)
+    clients.download_to_file(url, output_file)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("--prompt", type=str, required=True)
-    parser.add_argument("--output_file", type=str, required=True)
+    parser.add_argument("--prompt", type=str, required=False)
+    parser.add_argument("--output_file", type=str, required=False)
+    parser.add_argument(
+        "--data_file",
+        type=str,
+        required=False,
+        help="Generate every image in a data.json file instead of a single prompt",
+    )
+    parser.add_argument("--output_dir", type=str, required=False)
     parser.add_argument(
         "--image_svc",
         choices=["dall_e", "flux_schnell", "flux_pro"],
         default="dall_e",
         type=str,
     )
+    parser.add_argument(
+        "--fallback_svc",
+        choices=["dall_e", "flux_schnell", "flux_pro"],
+        required=False,
+        type=str,
+        help="Also ask this service when the primary one is slow or failing",
+    )
+    parser.add_argument(
+        "--hedge_after",
+        type=float,
+        default=HEDGE_AFTER,
+        help="Seconds to wait for the primary service before hedging",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        required=False,
+        help="Maximum parallel requests (default: per-service limit)",
+    )
     args = parser.parse_args()
-    create_image_from_prompt(args.prompt, args.output_file, args.image_svc)
+
+    if args.data_file:
+        if not args.output_dir:
+            parser.error("--output_dir is required with --data_file")
+        with open(args.data_file) as f:
+            data = json.load(f)
+        create_images_from_data(
+            data,
+            args.output_dir,
+            args.image_svc,
+            args.concurrency,
+            fallback_svc=args.fallback_svc,
+            hedge_after=args.hedge_after,
+        )
+    elif args.prompt and args.output_file:
+        create_image_from_prompt(
+            args.prompt,
+            args.output_file,
+            args.image_svc,
+            fallback_svc=args.fallback_svc,
+            hedge_after=args.hedge_after,
+        )
+    else:
+        parser.error("Specify either --prompt and --output_file or --data_file")
@@ -0,0 +1,92 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+import clients
+
+LLM_CACHE_DIR = os.getenv("SHORTROCITY_LLM_CACHE_DIR", os.path.join("cache", "llm"))
+LLM_CACHE_TTL = int(os.getenv("SHORTROCITY_LLM_CACHE_TTL", 7 * 24 * 60 * 60))
+
+
+def cache_key(model, messages, response_format=None):
+    payload = json.dumps(
+        {"model": model, "messages": messages, "response_format": response_format},
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def load_cached(key, ttl=LLM_CACHE_TTL):
+    path = os.path.join(LLM_CACHE_DIR, f"{key}.json")
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as f:
+        entry = json.load(f)
+
+    if time.time() - entry["created_at"] > ttl:
+        return None
+
+    return entry["content"]
+
+
+def store_cached(key, content):
+    os.makedirs(LLM_CACHE_DIR, exist_ok=True)
+    path = os.path.join(LLM_CACHE_DIR, f"{key}.json")
+
+    entry = {"created_at": time.time(), "content": content}
+    temp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(entry, f, ensure_ascii=False)
+    os.replace(temp_path, path)
+
+
+def complete(model, messages, response_format=None, use_cache=True, parse=None):
+    # parse turns the reply into what the caller needs, and a reply it
+    # rejects is never cached
+    if parse is None:
+        parse = str
+
+    key = cache_key(model, messages, response_format)
+    if use_cache:
+        content = load_cached(key)
+        if content is not None:
+            return parse(content)
+
+    kwargs = {}
+    if response_format is not None:
+        kwargs["response_format"] = response_format
+
+    response = clients.get_openai_client().chat.completions.create(
+        model=model, messages=messages, **kwargs
+    )
+
+    content = response.choices[0].message.content
+    result = parse(content)
+    store_cached(key, content)
+    return result
+
+
+def stream(model, messages, use_cache=True):
+    # Yields the response text as it arrives, or all at once from the cache
+    key = cache_key(model, messages)
+    if use_cache:
+        content = load_cached(key)
+        if content is not None:
+            yield content
+            return
+
+    response = clients.get_openai_client().chat.completions.create(
+        model=model, messages=messages, stream=True
+    )
+
+    parts = []
+    for chunk in response:
+        if chunk.choices and chunk.choices[0].delta.content:
+            parts.append(chunk.choices[0].delta.content)
+            yield chunk.choices[0].delta.content
+
+    store_cached(key, "".join(parts))
@@ -1,96 +1,352 @@
 #!/usr/bin/env python3
 
 import argparse
+import functools
 import json
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import dotenv
-from openai import OpenAI
 
+import asset_cache
 import images
+import llm_cache
+import metrics
 import narration
+import pipeline
 import upload
 import utils
 import video
 
 dotenv.load_dotenv()
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
 
-def main(system_prompt, user_prompt=None, caption_settings={}, image_svc="dall_e"):
+def main(
+    system_prompt,
+    user_prompt=None,
+    caption_settings={},
+    image_svc="dall_e",
+    image_concurrency=None,
+    image_fallback_svc=None,
+    hedge_after=images.HEDGE_AFTER,
+    render_backend="opencv",
+    single_pass=False,
+    transcribe_processes=None,
+    short_id=None,
+    render_executor=None,
+    resume=False,
+    force=(),
+    basedir=None,
+    only_scene=None,
+    metrics_prom=None,
+    render_workers=None,
+    use_llm_cache=True,
+    cache_script=False,
+    youtube_credentials=None,
+    animal=None,
+):
 
-    short_id = str(int(time.time()))
+    if basedir is not None:
+        short_id = os.path.basename(os.path.normpath(basedir))
+    else:
+        if short_id is None:
+            short_id = str(int(time.time()))
+        basedir = os.path.join("shorts", short_id)
+
+    if resume and not os.path.exists(basedir):
+        raise ValueError(f"Cannot resume, {basedir} does not exist")
 
-    output_file = "short.avi"
+    # The narration is loudness normalized while the video is built, so
+    # the render writes the final file directly
+    output_file = "normalized_short.avi"
 
-    youtube = upload.get_authenticated_service()
+    youtube = upload.get_authenticated_service(youtube_credentials)
 
-    basedir = os.path.join("shorts", short_id)
     if not os.path.exists(basedir):
         os.makedirs(basedir)
 
-    print("Generating script...")
+    # The script stage starts TTS and image jobs here as soon as each line
+    # of the streamed script arrives, so assets overlap script generation
+    asset_jobs = {"narration": [], "images": []}
+    asset_executors = {
+        "narration": ThreadPoolExecutor(max_workers=narration.MAX_CONCURRENCY),
+        "images": ThreadPoolExecutor(
+            max_workers=image_concurrency or images.MAX_CONCURRENCY.get(image_svc, 1)
+        ),
+    }
 
-    response = client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {
-                "role": "user",
-                "content": (
-                    user_prompt
-                    if user_prompt
-                    else f"Create a YouTube narration about the following animal:{utils.pick_random_animal('animals.txt', youtube)}"
-                ),
-            },
-        ],
-    )
+    def start_asset_job(element):
+        if element["type"] == "text":
+            jobs = asset_jobs["narration"]
+            output_file = os.path.join(
+                basedir, "narrations", f"narration_{len(jobs) + 1}.mp3"
+            )
+            future = metrics.submit(
+                asset_executors["narration"],
+                narration.synthesize,
+                element["content"],
+                output_file,
+            )
+        else:
+            jobs = asset_jobs["images"]
+            output_file = os.path.join(basedir, "images", f"image_{len(jobs) + 1}.webp")
+            future = metrics.submit(
+                asset_executors["images"],
+                images.create_image_from_prompt,
+                images.get_prompt(element),
+                output_file,
+                image_svc,
+                fallback_svc=image_fallback_svc,
+                hedge_after=hedge_after,
+            )
+        jobs.append((output_file, future))
+
+    def generate_script(results):
+        if system_prompt is None:
+            raise ValueError("A system prompt is required to generate the script")
+
+        print("Generating script...")
+
+        for folder in ("narrations", "images"):
+            os.makedirs(os.path.join(basedir, folder), exist_ok=True)
+
+        start = time.perf_counter()
+        # A fresh run writes a new script unless a cached one is asked for,
+        # otherwise the same prompts would make (and upload) the same short
+        stream = llm_cache.stream(
+            "gpt-4o",
+            [
+                {"role": "system", "content": system_prompt},
+                {
+                    "role": "user",
+                    "content": (
+                        user_prompt
+                        if user_prompt
+                        else f"Create a YouTube narration about the following animal:{animal or utils.pick_random_animal('animals.txt', youtube)}"
+                    ),
+                },
+            ],
+            use_cache=use_llm_cache and cache_script,
+        )
+
+        parts = []
+
+        def read_stream():
+            for text in stream:
+                parts.append(text)
+                yield text
+
+        data = []
+        for element in narration.parse_stream(read_stream()):
+            if not data:
+                elapsed = time.perf_counter() - start
+                print(f"First asset job started after {elapsed:.2f}s")
+            data.append(element)
+            start_asset_job(element)
+
+        response_text = "".join(parts)
+        response_text.replace("’", "'").replace("`", "'").replace("…", "...").replace(
+            "“", '"'
+        ).replace("”", '"')
+
+        with open(os.path.join(basedir, "response.txt"), "w") as f:
+            f.write(response_text)
+
+        narrations = [
+            element["content"] for element in data if element["type"] == "text"
+        ]
+        with open(os.path.join(basedir, "data.json"), "w") as f:
+            json.dump(data, f, ensure_ascii=False)
+
+        return data, narrations
+
+    def generate_narration(results):
+        print(f"Generating narration...")
+        data, _ = results["script"]
+
+        # Jobs were already started while the script streamed in
+        if asset_jobs["narration"]:
+            latencies = wait_for_assets(asset_jobs["narration"])
+            for (output_file, _), latency in zip(asset_jobs["narration"], latencies):
+                print(f"{os.path.basename(output_file)}: {latency:.2f}s")
+        else:
+            narration.create(data, os.path.join(basedir, "narrations"))
 
-    response_text = response.choices[0].message.content
-    response_text.replace("’", "'").replace("`", "'").replace("…", "...").replace(
-        "“", '"'
-    ).replace("”", '"')
+    def generate_images(results):
+        print("Generating images...")
+        data, _ = results["script"]
 
-    with open(os.path.join(basedir, "response.txt"), "w") as f:
-        f.write(response_text)
+        if asset_jobs["images"]:
+            wait_for_assets(asset_jobs["images"])
+        else:
+            images.create_images_from_data(
+                data,
+                os.path.join(basedir, "images"),
+                image_svc,
+                image_concurrency,
+                fallback_svc=image_fallback_svc,
+                hedge_after=hedge_after,
+            )
 
-    data, narrations = narration.parse(response_text)
-    with open(os.path.join(basedir, "data.json"), "w") as f:
-        json.dump(data, f, ensure_ascii=False)
+        # Letterbox every image into a frame once, so renders only map it
+        if video.uses_frames(render_backend, single_pass):
+            video.ingest_images(basedir)
 
-    print(f"Generating narration...")
-    narration.create(data, os.path.join(basedir, "narrations"))
+    def generate_video(results):
+        print("Generating video...")
+        _, narrations = results["script"]
+        render = functools.partial(
+            video.create,
+            narrations,
+            basedir,
+            output_file,
+            caption_settings,
+            backend=render_backend,
+            single_pass=single_pass,
+            transcribe_processes=transcribe_processes,
+            only_scene=only_scene,
+            render_workers=render_workers,
+            normalize_audio=True,
+        )
 
-    print("Generating images...")
-    images.create_images_from_data(data, os.path.join(basedir, "images"), image_svc)
+        # In batch mode rendering goes through a process pool sized to the cores
+        if render_executor is not None:
+            render_executor.submit(render).result()
+        else:
+            render()
 
-    print("Generating video...")
-    video.create(narrations, basedir, output_file, caption_settings)
+        print(
+            f"DONE! Here's your generated video: {os.path.join(basedir, output_file)}"
+        )
 
-    print("Normalizing sound...")
-    normalized_output_file = f"normalized_{output_file}"
-    utils.normalize_sound(basedir, output_file, normalized_output_file)
+    def generate_upload_config(results):
+        print("Generating upload config...")
+        return utils.generate_upload_config(basedir, use_cache=use_llm_cache)
 
-    print(
-        f"DONE! Here's your generated video: {os.path.join(basedir, normalized_output_file)}"
+    def upload_video(results):
+        print("Uploading video...")
+
+        config = upload.load_config(results["upload_config"])
+        if upload.upload_video(youtube, config) is True:
+            print(f"DONE! Uploaded video to YouTube")
+            return True
+        else:
+            print(f"FAILED! Failed to upload video to YouTube")
+            # Raise so the stage isn't recorded and --resume retries it,
+            # continuing the saved resumable session
+            raise RuntimeError("Failed to upload video to YouTube")
+
+    def script_files():
+        return [os.path.join(basedir, "data.json")]
+
+    def asset_files():
+        return [
+            os.path.join(basedir, folder, f)
+            for folder in ("narrations", "images")
+            for f in os.listdir(os.path.join(basedir, folder))
+            if f.endswith((".mp3", ".webp"))
+        ]
+
+    # Completed stages are recorded in stages.json with a hash of their
+    # inputs, so a resumed run only repeats stale or failed stages
+    stages = pipeline.Pipeline(
+        manifest_file=os.path.join(basedir, "stages.json"), force=force
     )
 
-    print("Generating upload config...")
-    upload_config_file = utils.generate_upload_config(basedir)
+    # Narration, images and the upload config only need the script, so
+    # they run in parallel as soon as it exists
+    # The script isn't reproducible (the topic may be picked at random), so
+    # once written it is only regenerated when forced
+    stages.add("script", generate_script)
+    stages.add(
+        "narration",
+        generate_narration,
+        deps=["script"],
+        params={"model": narration.TTS_MODEL, "voice": narration.TTS_VOICE},
+        files=script_files,
+    )
+    stages.add(
+        "images",
+        generate_images,
+        deps=["script"],
+        files=script_files,
+    )
+    stages.add(
+        "upload_config",
+        generate_upload_config,
+        deps=["script"],
+        files=lambda: [os.path.join(basedir, "response.txt")],
+    )
+    stages.add(
+        "video",
+        generate_video,
+        deps=["narration", "images"],
+        params={
+            "caption_settings": caption_settings,
+            "render_backend": render_backend,
+            "single_pass": single_pass,
+        },
+        files=asset_files,
+    )
+    stages.add("upload", upload_video, deps=["video", "upload_config"])
 
-    print("Uploading video...")
+    if resume:
+        adopt_existing_outputs(stages, basedir)
 
-    config = upload.load_config(upload_config_file)
-    if upload.upload_video(youtube, config) is True:
-        print(f"DONE! Uploaded video to YouTube")
-    else:
-        print(f"FAILED! Failed to upload video to YouTube")
+    tracer = metrics.Tracer(short_id=short_id, image_svc=image_svc)
+    token = metrics.activate(tracer)
+    try:
+        results = stages.run()
+    finally:
+        metrics.deactivate(token)
+        for executor in asset_executors.values():
+            executor.shutdown(cancel_futures=True)
+        stages.report()
+        print(f"Asset cache: {asset_cache.default_cache.stats()}")
+
+        tracer.write_json(os.path.join(basedir, "metrics.json"))
+        if metrics_prom:
+            metrics.write_prometheus(metrics_prom)
+
+    return {"short_id": short_id, "uploaded": results["upload"]}
+
+
+def wait_for_assets(jobs):
+    # Let every job finish before reporting, like create_images_from_data
+    failed = []
+    for output_file, future in jobs:
+        error = future.exception()
+        if error is not None:
+            print(f"Failed to generate {os.path.basename(output_file)}: {error}")
+            failed.append(os.path.basename(output_file))
+
+    if failed:
+        raise RuntimeError(f"Failed to generate assets: {', '.join(failed)}")
+
+    return [future.result() for _, future in jobs]
+
+
+def adopt_existing_outputs(stages, basedir):
+    data_file = os.path.join(basedir, "data.json")
+    if "script" in stages.manifest or not os.path.exists(data_file):
+        return
+
+    # Shorts made before stage manifests existed still have their script
+    # and assets on disk, so record those stages as completed
+    with open(data_file) as f:
+        data = json.load(f)
+    narrations = [element["content"] for element in data if element["type"] == "text"]
+    stages.complete("script", [data, narrations])
+
+    for name, folder in (("narration", "narrations"), ("images", "images")):
+        if os.path.isdir(os.path.join(basedir, folder)):
+            stages.complete(name)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("--system_prompt", type=str, required=True)
+    parser.add_argument("--system_prompt", type=str, required=False)
     parser.add_argument("--user_prompt", type=str, required=False)
     parser.add_argument("--caption_settings", type=str, required=False)
     parser.add_argument(
@@ -99,10 +355,75 @@ if __name__ == "__main__":
         default="dall_e",
         type=str,
     )
+    parser.add_argument("--image_concurrency", type=int, required=False)
+    parser.add_argument(
+        "--image_fallback_svc",
+        choices=["dall_e", "flux_schnell", "flux_pro"],
+        required=False,
+        type=str,
+        help="Also ask this service when --image_svc is slow or failing",
+    )
+    parser.add_argument(
+        "--hedge_after",
+        type=float,
+        default=images.HEDGE_AFTER,
+        help="Seconds to wait for --image_svc before asking the fallback",
+    )
+    parser.add_argument(
+        "--render_backend",
+        choices=["opencv", "ffmpeg", "chunked"],
+        default="opencv",
+        type=str,
+    )
+    parser.add_argument(
+        "--render_workers",
+        type=int,
+        required=False,
+        help="Render scenes in this many processes and join them losslessly",
+    )
+    parser.add_argument(
+        "--single_pass",
+        action="store_true",
+        help="Encode frames and the normalized narration in one ffmpeg pass",
+    )
+    parser.add_argument(
+        "--transcribe_processes",
+        type=int,
+        required=False,
+        help="Spread caption transcription across this many processes",
+    )
+    parser.add_argument(
+        "--resume",
+        type=str,
+        required=False,
+        metavar="SHORT_ID",
+        help="Continue an earlier run, repeating only stale or failed stages",
+    )
+    parser.add_argument(
+        "--no_llm_cache",
+        action="store_true",
+        help="Always call the model instead of reusing cached responses",
+    )
+    parser.add_argument(
+        "--cache_script",
+        action="store_true",
+        help="Reuse a cached script for the same prompts instead of writing a new one",
+    )
+    parser.add_argument(
+        "--metrics_prom",
+        type=str,
+        required=False,
+        help="Also write stage timings to this Prometheus textfile",
+    )
     args = parser.parse_args()
 
-    with open(args.system_prompt) as f:
-        system_prompt = f.read()
+    if not args.system_prompt and not args.resume:
+        parser.error("--system_prompt is required unless resuming")
+
+    system_prompt = None
+    if args.system_prompt:
+        with open(args.system_prompt) as f:
+            system_prompt = f.read()
 
     user_prompt = args.user_prompt if args.user_prompt else None
 
@@ -113,4 +434,21 @@ if __name__ == "__main__":
 
     image_svc = args.image_svc
 
-    main(system_prompt, user_prompt, caption_settings, image_svc)
+    main(
+        system_prompt,
+        user_prompt,
+        caption_settings,
+        image_svc,
+        image_concurrency=args.image_concurrency,
+        image_fallback_svc=args.image_fallback_svc,
+        hedge_after=args.hedge_after,
+        render_backend=args.render_backend,
+        single_pass=args.single_pass,
+        transcribe_processes=args.transcribe_processes,
+        short_id=args.resume,
+        resume=args.resume is not None,
+        metrics_prom=args.metrics_prom,
+        render_workers=args.render_workers,
+        use_llm_cache=not args.no_llm_cache,
+        cache_script=args.cache_script,
+    )
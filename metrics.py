@@ -0,0 +1,143 @@
+import contextvars
+import itertools
+import json
+import os
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds of the Prometheus histogram buckets, in seconds
+BUCKETS = [0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600]
+
+_current_tracer = contextvars.ContextVar("tracer", default=None)
+_current_span = contextvars.ContextVar("span", default=None)
+_span_ids = itertools.count(1)
+
+_histograms = {}
+_histograms_lock = threading.Lock()
+
+
+class Tracer:
+    def __init__(self, **attributes):
+        self.attributes = attributes
+        self.spans = []
+        self.started_at = time.time()
+        self.origin = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def record(self, entry):
+        with self.lock:
+            self.spans.append(entry)
+
+        with _histograms_lock:
+            key = (entry["name"], self.attributes.get("image_svc", ""))
+            histogram = _histograms.setdefault(
+                key, {"buckets": [0] * len(BUCKETS), "sum": 0.0, "count": 0}
+            )
+            for i, bound in enumerate(BUCKETS):
+                if entry["duration"] <= bound:
+                    histogram["buckets"][i] += 1
+            histogram["sum"] += entry["duration"]
+            histogram["count"] += 1
+
+    def write_json(self, path):
+        with self.lock:
+            spans = sorted(self.spans, key=lambda entry: entry["start"])
+        with open(path, "w") as f:
+            json.dump(
+                {
+                    "attributes": self.attributes,
+                    "started_at": self.started_at,
+                    "spans": spans,
+                },
+                f,
+                indent=2,
+                default=str,
+            )
+
+
+def activate(tracer):
+    return _current_tracer.set(tracer)
+
+
+def deactivate(token):
+    _current_tracer.reset(token)
+
+
+@contextmanager
+def span(name, **attributes):
+    tracer = _current_tracer.get()
+    if tracer is None:
+        yield {"attributes": attributes}
+        return
+
+    parent = _current_span.get()
+    entry = {
+        "id": next(_span_ids),
+        "parent": parent["id"] if parent else None,
+        "name": name,
+        "attributes": attributes,
+        "thread": threading.current_thread().name,
+    }
+    token = _current_span.set(entry)
+    start = time.perf_counter()
+    try:
+        yield entry
+    except Exception as e:
+        entry["error"] = repr(e)
+        raise
+    finally:
+        end = time.perf_counter()
+        _current_span.reset(token)
+        entry["start"] = round(start - tracer.origin, 6)
+        entry["duration"] = round(end - start, 6)
+        tracer.record(entry)
+
+
+def submit(executor, func, *args, **kwargs):
+    # Worker threads don't inherit context variables, so run the task in
+    # a copy of the submitter's context to keep spans attached to the short
+    context = contextvars.copy_context()
+    return executor.submit(context.run, func, *args, **kwargs)
+
+
+def run(command, name=None, **kwargs):
+    with span(name or command[0], command=command[0]) as entry:
+        try:
+            result = subprocess.run(command, **kwargs)
+        except subprocess.CalledProcessError as e:
+            entry["attributes"]["exit_code"] = e.returncode
+            raise
+        entry["attributes"]["exit_code"] = result.returncode
+        return result
+
+
+def write_prometheus(path):
+    lines = [
+        "# HELP shortrocity_span_duration_seconds Duration of pipeline spans.",
+        "# TYPE shortrocity_span_duration_seconds histogram",
+    ]
+
+    with _histograms_lock:
+        for (name, image_svc), histogram in sorted(_histograms.items()):
+            labels = f'span="{name}",image_svc="{image_svc}"'
+            for bound, count in zip(BUCKETS, histogram["buckets"]):
+                lines.append(
+                    f'shortrocity_span_duration_seconds_bucket{{{labels},le="{bound}"}} {count}'
+                )
+            lines.append(
+                f'shortrocity_span_duration_seconds_bucket{{{labels},le="+Inf"}} {histogram["count"]}'
+            )
+            lines.append(
+                f"shortrocity_span_duration_seconds_sum{{{labels}}} {histogram['sum']}"
+            )
+            lines.append(
+                f"shortrocity_span_duration_seconds_count{{{labels}}} {histogram['count']}"
+            )
+
+    # Write atomically so the node exporter never reads a partial file
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(temp_path, path)
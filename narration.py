@@ -1,8 +1,13 @@
 # from elevenlabs.client import ElevenLabs
 # from elevenlabs import save
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-import openai
+import asset_cache
+import audio_index
+import clients
+import metrics
 
 # elevenlabs = ElevenLabs(
 #     api_key=os.getenv("ELEVEN_API_KEY")
@@ -10,36 +15,63 @@ import openai
 
 narration_api = "openai"  # (or "elevenlabs")
 
+MAX_CONCURRENCY = 4
+
+TTS_MODEL = "tts-1-hd"
+TTS_VOICE = "alloy"
+
+
+def parse_line(line):
+    if line.startswith("Narrator: "):
+        text = line.replace("Narrator: ", "")
+        return {
+            "type": "text",
+            "content": text.strip('"'),
+        }
+    elif line.startswith("["):
+        background = line.strip("[]")
+        return {
+            "type": "image",
+            "description": background,
+        }
+    return None
+
 
 def parse(narration):
     data = []
     narrations = []
     lines = narration.split("\n")
     for line in lines:
-        if line.startswith("Narrator: "):
-            text = line.replace("Narrator: ", "")
-            data.append(
-                {
-                    "type": "text",
-                    "content": text.strip('"'),
-                }
-            )
-            narrations.append(text.strip('"'))
-        elif line.startswith("["):
-            background = line.strip("[]")
-            data.append(
-                {
-                    "type": "image",
-                    "description": background,
-                }
-            )
+        element = parse_line(line)
+        if element is None:
+            continue
+        data.append(element)
+        if element["type"] == "text":
+            narrations.append(element["content"])
     return data, narrations
 
 
-def create(data, output_folder):
+def parse_stream(chunks):
+    # Emit each element as soon as the newline ending its line arrives
+    buffer = ""
+    for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split("\n")
+        for line in lines:
+            element = parse_line(line)
+            if element is not None:
+                yield element
+
+    element = parse_line(buffer)
+    if element is not None:
+        yield element
+
+
+def create(data, output_folder, max_workers=MAX_CONCURRENCY):
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
 
+    jobs = []
     n = 0
     for element in data:
         if element["type"] != "text":
@@ -47,6 +79,7 @@ def create(data, output_folder):
 
         n += 1
         output_file = os.path.join(output_folder, f"narration_{n}.mp3")
+        jobs.append((element["content"], output_file))
 
         # if narration_api == "openai":
         #     audio = openai.audio.speech.create(
@@ -64,10 +97,54 @@ def create(data, output_folder):
         #     )
         #     save(audio, output_file)
 
-        audio = openai.audio.speech.create(
-            input=element["content"],
-            model="tts-1-hd",
-            voice="alloy",
+    if not jobs:
+        return []
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(jobs)))) as executor:
+        futures = [
+            metrics.submit(executor, synthesize, text, output_file)
+            for text, output_file in jobs
+        ]
+
+    # Record durations while the clips are fresh so rendering never decodes them
+    index = audio_index.load(os.path.dirname(os.path.abspath(output_folder)))
+
+    latencies = []
+    for (_, output_file), future in zip(jobs, futures):
+        latency = future.result()
+        latencies.append(latency)
+        duration = index.duration_ms(output_file)
+        print(
+            f"{os.path.basename(output_file)}: {latency:.2f}s "
+            f"({duration / 1000:.1f}s of audio)"
         )
 
-        audio.stream_to_file(output_file)
+    return latencies
+
+
+def synthesize(text, output_file, cache=asset_cache.default_cache):
+    start = time.perf_counter()
+
+    with metrics.span("tts", file=os.path.basename(output_file)) as span:
+        if cache is not None:
+            cache_key = cache.key("openai", TTS_MODEL, {"voice": TTS_VOICE}, text)
+            span["attributes"]["cache_hit"] = cache.fetch(cache_key, output_file)
+            if span["attributes"]["cache_hit"]:
+                return time.perf_counter() - start
+
+        # Stream the response body straight to disk as it arrives. It goes
+        # to a new file, the old one may be hardlinked from the asset cache
+        client = clients.get_openai_client()
+        temp_file = f"{output_file}.part"
+        with client.audio.speech.with_streaming_response.create(
+            input=text,
+            model=TTS_MODEL,
+            voice=TTS_VOICE,
+        ) as response:
+            response.stream_to_file(temp_file)
+        os.replace(temp_file, output_file)
+
+        if cache is not None:
+            cache.store(cache_key, output_file)
+
+    return time.perf_counter() - start
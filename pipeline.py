@@ -0,0 +1,167 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import metrics
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Pipeline:
+    def __init__(self, max_workers=8, manifest_file=None, force=()):
+        self.max_workers = max_workers
+        self.manifest_file = manifest_file
+        self.force = set(force)
+        self.stages = {}
+        self.results = {}
+        self.timings = {}
+        self.origin = time.perf_counter()
+        self.executed = set()
+        self.manifest = {}
+        self.lock = threading.Lock()
+
+        if manifest_file and os.path.exists(manifest_file):
+            with open(manifest_file) as f:
+                self.manifest = json.load(f)
+
+    def add(self, name, func, deps=(), params=None, files=None):
+        for dep in deps:
+            if dep not in self.stages:
+                raise ValueError(f"Stage '{name}' depends on unknown stage '{dep}'")
+        self.stages[name] = (func, tuple(deps), params, files)
+
+    def fingerprint(self, name):
+        _, deps, params, files = self.stages[name]
+
+        # A stage's key covers its parameters, the keys of the stages it
+        # depends on and the contents of the files it reads
+        digest = hashlib.sha256()
+        digest.update(json.dumps(params, sort_keys=True, default=str).encode("utf-8"))
+        for dep in deps:
+            digest.update(self.manifest.get(dep, {}).get("key", "").encode("utf-8"))
+        for path in sorted(files() if files else []):
+            digest.update(path.encode("utf-8"))
+            digest.update(hash_file(path).encode("utf-8"))
+        return digest.hexdigest()
+
+    def is_complete(self, name):
+        if name in self.force:
+            return False
+        if any(dep in self.executed for dep in self.stages[name][1]):
+            return False
+        entry = self.manifest.get(name)
+        return entry is not None and entry["key"] == self.fingerprint(name)
+
+    def complete(self, name, result=None):
+        entry = {
+            "key": self.fingerprint(name),
+            "result": result,
+            "completed_at": time.time(),
+        }
+        with self.lock:
+            self.manifest[name] = entry
+            self.save()
+
+    def save(self):
+        if not self.manifest_file:
+            return
+        temp_path = f"{self.manifest_file}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self.manifest, f, indent=2, ensure_ascii=False)
+        os.replace(temp_path, self.manifest_file)
+
+    def run(self):
+        pending = dict(self.stages)
+        running = {}
+        error = None
+        self.origin = time.perf_counter()
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                # Start every stage whose inputs are ready
+                if error is None:
+                    ready = True
+                    while ready:
+                        ready = False
+                        for name, (func, deps, _, _) in list(pending.items()):
+                            if not all(dep in self.results for dep in deps):
+                                continue
+                            del pending[name]
+                            if self.manifest_file and self.is_complete(name):
+                                print(f"Skipping completed stage '{name}'")
+                                self.results[name] = self.manifest[name]["result"]
+                                ready = True
+                            else:
+                                future = metrics.submit(
+                                    executor, self._run_stage, name, func
+                                )
+                                running[future] = name
+
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        self.results[name] = future.result()
+                    except Exception as e:
+                        print(f"Stage '{name}' failed: {e}")
+                        with self.lock:
+                            self.manifest.pop(name, None)
+                            self.save()
+                        if error is None:
+                            error = e
+                        continue
+                    self.executed.add(name)
+                    self.complete(name, self.results[name])
+
+        if error is not None:
+            raise error
+
+        return self.results
+
+    def _run_stage(self, name, func):
+        # Timings are relative to the start of run(), so a report after a
+        # failed run reads the same as one after a successful run
+        start = time.perf_counter() - self.origin
+        try:
+            with metrics.span(f"stage.{name}"):
+                return func(self.results)
+        finally:
+            self.timings[name] = (start, time.perf_counter() - self.origin)
+
+    def critical_path(self):
+        if not self.timings:
+            return []
+
+        # Walk back from the last stage to finish through the dependency
+        # that finished last, which is the one that gated it
+        name = max(self.timings, key=lambda n: self.timings[n][1])
+        path = [name]
+        while True:
+            deps = [dep for dep in self.stages[name][1] if dep in self.timings]
+            if not deps:
+                break
+            name = max(deps, key=lambda n: self.timings[n][1])
+            path.append(name)
+
+        return list(reversed(path))
+
+    def report(self):
+        path = self.critical_path()
+        for name in path:
+            start, end = self.timings[name]
+            print(f"  {name}: {end - start:.2f}s (at {start:.2f}s - {end:.2f}s)")
+        if path:
+            total = self.timings[path[-1]][1]
+            print(f"Critical path: {' -> '.join(path)} ({total:.2f}s)")
@@ -0,0 +1,133 @@
+import random
+import threading
+import time
+
+import httpx
+import requests
+from openai import APIConnectionError
+
+# Sustained requests per second and burst size for each provider
+RATE_LIMITS = {
+    "openai": (1.0, 5),
+    "replicate": (5.0, 8),
+}
+# A throttled bucket never drops below this fraction of its configured rate
+MIN_RATE_FRACTION = 0.1
+
+MAX_RETRIES = 4
+BASE_BACKOFF = 1.0  # seconds
+MAX_BACKOFF = 30.0  # seconds
+RETRY_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self.updated
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self.blocked_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = max(self.blocked_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(delay)
+
+    def throttle(self, retry_after=None):
+        # Halve the rate on every 429 and hold all callers for as long as
+        # the provider asked, then creep back up on successes
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.rate = max(self.max_rate * MIN_RATE_FRACTION, self.rate / 2)
+            self.tokens = 0
+            if retry_after:
+                self.blocked_until = max(self.blocked_until, now + retry_after)
+
+    def recover(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * 0.1)
+
+
+def get_bucket(provider):
+    with _buckets_lock:
+        if provider not in _buckets:
+            _buckets[provider] = TokenBucket(*RATE_LIMITS[provider])
+        return _buckets[provider]
+
+
+def status_code(error):
+    # OpenAI errors carry status_code, Replicate errors status and
+    # requests errors a response
+    for attribute in ("status_code", "status"):
+        status = getattr(error, attribute, None)
+        if isinstance(status, int):
+            return status
+    response = getattr(error, "response", None)
+    return getattr(response, "status_code", None)
+
+
+def retry_after(error):
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def is_retryable(error):
+    if status_code(error) in RETRY_STATUSES:
+        return True
+    return isinstance(
+        error,
+        (
+            APIConnectionError,
+            httpx.TransportError,
+            requests.ConnectionError,
+            requests.Timeout,
+        ),
+    )
+
+
+def call(provider, func, *args, max_retries=MAX_RETRIES, **kwargs):
+    bucket = get_bucket(provider)
+
+    attempt = 0
+    while True:
+        bucket.acquire()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            if status_code(e) == 429:
+                bucket.throttle(retry_after(e))
+            if attempt >= max_retries or not is_retryable(e):
+                raise
+
+            # Full jitter keeps parallel workers from retrying in lockstep
+            delay = retry_after(e) or random.uniform(
+                0, min(MAX_BACKOFF, BASE_BACKOFF * 2**attempt)
+            )
+            print(f"{provider} request failed ({e}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+            attempt += 1
+            continue
+
+        bucket.recover()
+        return result
@@ -5,9 +5,7 @@ import json
 import os
 
 import images
-import upload
-import utils
-import video
+import main
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Process image generation and caption settings.")
@@ -44,49 +42,118 @@ if __name__ == "__main__":
         help="The image generation service to use (default: 'dall_e')."
     )
 
+    # Optional argument for limiting parallel image generation requests
+    parser.add_argument(
+        "--image_concurrency",
+        type=int,
+        required=False,
+        help="Maximum parallel image generation requests (default: per-service limit)."
+    )
+
+    # Optional argument for hedging slow image requests with a second service
+    parser.add_argument(
+        "--image_fallback_svc",
+        choices=["dall_e", "flux_schnell", "flux_pro"],
+        required=False,
+        type=str,
+        help="Also ask this service when --image_svc is slow or failing (default: None)."
+    )
+
+    # Optional argument for how long to wait before hedging
+    parser.add_argument(
+        "--hedge_after",
+        type=float,
+        default=images.HEDGE_AFTER,
+        help=f"Seconds to wait for --image_svc before asking the fallback service (default: {images.HEDGE_AFTER})."
+    )
+
+    # Optional argument for selecting how frames are composited
+    parser.add_argument(
+        "--render_backend",
+        choices=["opencv", "ffmpeg", "chunked"],
+        default="chunked",
+        type=str,
+        help="Render frames in Python with OpenCV, as one ffmpeg filter graph, or as cached per-scene chunks that are only rebuilt when their inputs change (default: 'chunked')."
+    )
+
+    # Optional argument for rendering scenes in parallel
+    parser.add_argument(
+        "--render_workers",
+        type=int,
+        required=False,
+        help="Number of processes that render scenes in parallel with the 'opencv' and 'chunked' backends (default: 1)."
+    )
+
+    # Optional argument to rebuild a single scene
+    parser.add_argument(
+        "--only_scene",
+        "--only-scene",
+        type=int,
+        required=False,
+        help="Only re-render this scene (1-based) and reuse the other chunks as they are."
+    )
+
+    # Optional boolean argument to encode everything in one ffmpeg pass
+    parser.add_argument(
+        "--single_pass",
+        action="store_true",
+        help="Encode frames and the normalized narration in a single ffmpeg pass (default: False)."
+    )
+
+    # Optional argument for transcribing captions in parallel
+    parser.add_argument(
+        "--transcribe_processes",
+        type=int,
+        required=False,
+        help="Number of processes used to transcribe narrations for captions (default: 1)."
+    )
+
+    # Optional boolean argument to bypass the LLM response cache
+    parser.add_argument(
+        "--no_llm_cache",
+        action="store_true",
+        help="Ask the model for a new title and description instead of reusing them (default: False)."
+    )
+
     args = parser.parse_args()
 
-    basedir = args.basedir
-    narrations = [
-        f for f in os.listdir(os.path.join(basedir, "narrations")) if f.endswith(".mp3")
-    ]
+    if args.only_scene is not None and args.render_backend != "chunked":
+        parser.error("--only_scene requires the 'chunked' render backend")
+
+    if args.only_scene is not None:
+        images_dir = os.path.join(args.basedir, "images")
+        image_count = len([f for f in os.listdir(images_dir) if f.endswith(".webp")])
+        if not 1 <= args.only_scene <= image_count:
+            parser.error(f"--only_scene must be between 1 and {image_count}")
+
     caption_settings = {}
     if args.caption_settings:
         with open(args.caption_settings) as f:
             caption_settings = json.load(f)
 
+    # Regenerating is a resume that forces the video (and optionally the
+    # images) to be rebuilt, everything downstream follows automatically.
+    # The upload config is only redone if the script changed
+    force = ["video"]
+    if args.no_llm_cache:
+        force.append("upload_config")
     if args.regenerate_images:
-        print("Regenerating images...")
-        data = json.load(open(os.path.join(basedir, "data.json")))
-        images.create_images_from_data(
-            data, os.path.join(basedir, "images"), args.image_svc
-        )
-
-    output_file = "short.avi"
-
-    print("Regenerating video...")
-    video.create(
-        narrations,
-        basedir,
-        output_filename=output_file,
-        caption_settings=caption_settings,
-    )
-
-    print("Normalizing sound...")
-    normalized_output_file = f"normalized_{output_file}"
-    utils.normalize_sound(basedir, output_file, normalized_output_file)
+        force.append("images")
 
-    print(
-        f"DONE! Here's your regenerated video: {os.path.join(basedir, normalized_output_file)}"
+    main.main(
+        None,
+        caption_settings=caption_settings,
+        image_svc=args.image_svc,
+        image_concurrency=args.image_concurrency,
+        image_fallback_svc=args.image_fallback_svc,
+        hedge_after=args.hedge_after,
+        render_backend=args.render_backend,
+        single_pass=args.single_pass,
+        transcribe_processes=args.transcribe_processes,
+        resume=True,
+        force=force,
+        basedir=args.basedir,
+        only_scene=args.only_scene,
+        render_workers=args.render_workers,
+        use_llm_cache=not args.no_llm_cache,
     )
-
-    print("Regenerating upload config...")
-    upload_config_file = utils.generate_upload_config(basedir)
-
-    print("Uploading video...")
-    youtube = upload.get_authenticated_service()
-    config = upload.load_config(upload_config_file)
-    if upload.upload_video(youtube, config) is True:
-        print(f"DONE! Uploaded video to YouTube")
-    else:
-        print(f"FAILED! Failed to upload video to YouTube")
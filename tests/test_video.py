@@ -0,0 +1,106 @@
+import math
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+cv2 = pytest.importorskip("cv2")
+pytest.importorskip("captacity")
+
+import video
+
+WIDTH, HEIGHT = 108, 192
+FRAME_RATE = 30
+FADE_TIME = 200
+HOLD_FRAMES = [5, 3, 4]
+
+
+def per_frame_loop(output_dir):
+    # The frame loop from before FrameProvider, kept as the reference
+    image_count = video.get_image_count(output_dir)
+    for i in range(image_count):
+        image1_path, image2_path = video.get_scene_images(output_dir, i, image_count)
+        image1 = video.resize_image(cv2.imread(image1_path), WIDTH, HEIGHT)
+        image2 = video.resize_image(cv2.imread(image2_path), WIDTH, HEIGHT)
+
+        for _ in range(HOLD_FRAMES[i]):
+            frame = np.zeros((HEIGHT, WIDTH, 3), dtype=np.uint8)
+            frame[: image1.shape[0], :] = image1
+            yield frame
+
+        for alpha in np.linspace(0, 1, math.floor(FADE_TIME / 1000 * FRAME_RATE)):
+            blended = cv2.addWeighted(image1, 1 - alpha, image2, alpha, 0)
+            frame = np.zeros((HEIGHT, WIDTH, 3), dtype=np.uint8)
+            frame[: image1.shape[0], :] = blended
+            yield frame
+
+
+@pytest.fixture
+def short_dir(tmp_path, monkeypatch):
+    os.makedirs(tmp_path / "images")
+    rng = np.random.default_rng(0)
+    for i in range(len(HOLD_FRAMES)):
+        image = rng.integers(0, 256, (179, 102, 3), dtype=np.uint8)
+        cv2.imwrite(str(tmp_path / "images" / f"image_{i + 1}.webp"), image)
+
+    # Hold lengths normally come from the narration clips
+    monkeypatch.setattr(video, "get_hold_frames", lambda *args: HOLD_FRAMES)
+    return str(tmp_path)
+
+
+def assert_same_frames(output_dir):
+    expected = [frame.copy() for frame in per_frame_loop(output_dir)]
+    # Yielded frames are reused buffers, so copy each one as it arrives
+    actual = [
+        np.array(frame)
+        for frame in video.generate_frames(
+            output_dir, WIDTH, HEIGHT, FRAME_RATE, FADE_TIME
+        )
+    ]
+
+    assert len(actual) == len(expected)
+    for expected_frame, actual_frame in zip(expected, actual):
+        assert np.array_equal(expected_frame, actual_frame)
+
+
+def test_generate_frames_matches_per_frame_loop(short_dir):
+    assert_same_frames(short_dir)
+
+
+def test_scenes_rendered_separately_match_generate_frames(short_dir):
+    # Parallel workers render each scene with their own provider
+    image_count = video.get_image_count(short_dir)
+    scene_frames = []
+    for i in range(image_count):
+        provider = video.FrameProvider(WIDTH, HEIGHT)
+        image1, image2 = video.get_scene_images(short_dir, i, image_count)
+        scene_frames += [
+            np.array(frame)
+            for frame in video.generate_scene_frames(
+                provider, image1, image2, HOLD_FRAMES[i], FRAME_RATE, FADE_TIME
+            )
+        ]
+
+    serial_frames = [
+        np.array(frame)
+        for frame in video.generate_frames(
+            short_dir, WIDTH, HEIGHT, FRAME_RATE, FADE_TIME
+        )
+    ]
+
+    assert len(scene_frames) == len(serial_frames)
+    for scene_frame, serial_frame in zip(scene_frames, serial_frames):
+        assert np.array_equal(scene_frame, serial_frame)
+
+
+def test_generate_frames_matches_with_ingested_frames(short_dir, monkeypatch):
+    video.ingest_images(short_dir, WIDTH, HEIGHT)
+    assert os.path.exists(os.path.join(short_dir, "images", "image_1.npy"))
+
+    # Renders must read the mapped frames instead of decoding the images
+    def prepare_frame(*args):
+        raise AssertionError("image decoded despite an ingested frame")
+
+    monkeypatch.setattr(video, "prepare_frame", prepare_frame)
+
+    assert_same_frames(short_dir)
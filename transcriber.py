@@ -0,0 +1,145 @@
+import hashlib
+import importlib.util
+import json
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import captacity
+
+WHISPER_MODEL = "base"
+
+# Bump when the transcriber or its output changes to invalidate old entries
+TRANSCRIPT_CACHE_VERSION = 1
+TRANSCRIPT_CACHE_DIR = os.getenv(
+    "SHORTROCITY_TRANSCRIPT_CACHE_DIR", os.path.join("cache", "transcripts")
+)
+
+_model = None
+_model_lock = threading.Lock()
+
+
+def load_model():
+    global _model
+
+    import whisper
+
+    # Load the model once per process and share it between clips
+    with _model_lock:
+        if _model is None:
+            _model = whisper.load_model(WHISPER_MODEL)
+        return _model
+
+
+def transcribe(audio_file, prompt=None):
+    try:
+        model = load_model()
+    except ImportError:
+        return captacity.transcriber.transcribe_with_api(
+            audio_file=audio_file,
+            prompt=prompt,
+        )
+
+    # Whisper models aren't safe to share between threads
+    with _model_lock:
+        transcription = model.transcribe(
+            audio=audio_file,
+            word_timestamps=True,
+            fp16=False,
+            initial_prompt=prompt,
+        )
+
+    return transcription["segments"]
+
+
+def _init_worker():
+    try:
+        load_model()
+    except ImportError:
+        pass
+
+
+def _transcribe_clip(clip):
+    audio_file, prompt = clip
+    return transcribe(audio_file, prompt)
+
+
+def transcribe_batch(clips, processes=None, use_cache=True):
+    results = [None] * len(clips)
+    keys = [None] * len(clips)
+
+    if use_cache:
+        for i, (audio_file, prompt) in enumerate(clips):
+            keys[i] = cache_key(audio_file, prompt)
+            results[i] = load_cached(keys[i])
+
+    missing = [i for i, segments in enumerate(results) if segments is None]
+    todo = [clips[i] for i in missing]
+
+    if not processes or processes < 2 or len(todo) < 2:
+        transcribed = [transcribe(audio_file, prompt) for audio_file, prompt in todo]
+    else:
+        # Each worker loads the model once and then takes clips in order.
+        # Workers are spawned, forking a threaded parent that may already
+        # hold torch can deadlock them
+        with ProcessPoolExecutor(
+            max_workers=min(processes, len(todo)),
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+        ) as executor:
+            transcribed = list(executor.map(_transcribe_clip, todo))
+
+    for i, segments in zip(missing, transcribed):
+        if use_cache:
+            store_cached(keys[i], segments)
+        results[i] = segments
+
+    if use_cache:
+        hits = len(clips) - len(missing)
+        print(f"Transcript cache: {hits} hits, {len(missing)} misses")
+
+    return results
+
+
+def cache_key(audio_file, prompt):
+    if importlib.util.find_spec("whisper") is not None:
+        model = f"whisper-{WHISPER_MODEL}"
+    else:
+        model = "whisper-1-api"
+
+    digest = hashlib.sha256()
+    with open(audio_file, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+
+    digest.update(json.dumps([model, prompt]).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def load_cached(key):
+    path = os.path.join(TRANSCRIPT_CACHE_DIR, f"{key}.json")
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as f:
+        entry = json.load(f)
+
+    if entry.get("version") != TRANSCRIPT_CACHE_VERSION:
+        return None
+
+    return entry["segments"]
+
+
+def store_cached(key, segments):
+    os.makedirs(TRANSCRIPT_CACHE_DIR, exist_ok=True)
+    path = os.path.join(TRANSCRIPT_CACHE_DIR, f"{key}.json")
+
+    # Whisper may hand back numpy scalars, which json can't serialize
+    # Render processes can store the same clip at once, so each writer gets
+    # its own temp file
+    entry = {"version": TRANSCRIPT_CACHE_VERSION, "segments": segments}
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(entry, f, default=float)
+    os.replace(temp_path, path)
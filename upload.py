@@ -2,20 +2,46 @@ import argparse
 import json
 import os
 import pickle
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import google_auth_oauthlib.flow
 import googleapiclient.discovery
 import googleapiclient.errors
+import httplib2
 from google.auth.transport.requests import Request
 from googleapiclient.http import MediaFileUpload
 
 import constants
+import metrics
 
 SCOPES = [
     "https://www.googleapis.com/auth/youtube.upload",
     "https://www.googleapis.com/auth/youtube.force-ssl",
 ]
 TOKEN_PICKLE_FILE = "token.pickle"
+TITLES_INDEX_FILE = "uploaded_titles.json"
+TITLES_SYNC_INTERVAL = 24 * 60 * 60  # seconds
+
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+MAX_UPLOAD_RETRIES = 10
+MAX_CONCURRENT_UPLOADS = 3
+RETRIABLE_STATUS_CODES = [500, 502, 503, 504]
+RETRIABLE_EXCEPTIONS = (httplib2.HttpLib2Error, IOError)
+
+DESCRIPTIONS_INDEX_FILE = "updated_descriptions.json"
+
+# YouTube Data API quota cost per call
+QUOTA_COSTS = {
+    "channels.list": 1,
+    "playlistItems.list": 1,
+    "videos.list": 1,
+    "videos.update": 50,
+}
+
+_titles_index_lock = threading.Lock()
 
 
 def load_config(file_path):
@@ -23,7 +49,7 @@ def load_config(file_path):
         return json.load(file)
 
 
-def get_authenticated_service():
+def get_credentials():
     credentials = None
     if os.path.exists(TOKEN_PICKLE_FILE):
         with open(TOKEN_PICKLE_FILE, "rb") as token:
@@ -42,29 +68,134 @@ def get_authenticated_service():
         with open(TOKEN_PICKLE_FILE, "wb") as token:
             pickle.dump(credentials, token)
 
+    return credentials
+
+
+def get_authenticated_service(credentials=None):
+    # Callers that share credentials (batch jobs) skip the token file, the
+    # client refreshes an expired token in memory
+    if credentials is None:
+        credentials = get_credentials()
     return googleapiclient.discovery.build("youtube", "v3", credentials=credentials)
 
 
-def upload_video(youtube, config):
-    body = {
-        "snippet": {
-            "title": config["title"],
-            "description": config["description"],
-            "categoryId": config["category"],
-        },
-        "status": {"privacyStatus": config["privacy_status"]},
-    }
-    media = MediaFileUpload(config["file_path"], chunksize=-1, resumable=True)
-    try:
-        request = youtube.videos().insert(
-            part="snippet,status", body=body, media_body=media
-        )
-        response = request.execute()
+def upload_video(
+    youtube, config, chunksize=UPLOAD_CHUNK_SIZE, max_retries=MAX_UPLOAD_RETRIES
+):
+    with metrics.span("upload", file=os.path.basename(config["file_path"])):
+        body = {
+            "snippet": {
+                "title": config["title"],
+                "description": config["description"],
+                "categoryId": config["category"],
+            },
+            "status": {"privacyStatus": config["privacy_status"]},
+        }
+        file_path = config["file_path"]
+        state_file = f"{file_path}.upload.json"
+
+        def create_request():
+            media = MediaFileUpload(file_path, chunksize=chunksize, resumable=True)
+            return youtube.videos().insert(
+                part="snippet,status", body=body, media_body=media
+            )
+
+        request = create_request()
+
+        # Continue an upload session left behind by an earlier process
+        state = load_upload_state(state_file, file_path)
+        if state:
+            print(f"Resuming upload of {file_path}")
+            request.resumable_uri = state["resumable_uri"]
+            request._in_error_state = True
+
+        response = None
+        retry = 0
+        while response is None:
+            error = None
+            try:
+                with metrics.span("upload.chunk"):
+                    status, response = request.next_chunk()
+                if request.resumable_uri and not state:
+                    state = save_upload_state(
+                        state_file, file_path, request.resumable_uri
+                    )
+                if status:
+                    progress = int(status.progress() * 100)
+                    print(f"Uploaded {progress}% of {file_path}")
+                retry = 0
+            except googleapiclient.errors.HttpError as e:
+                if e.resp.status in RETRIABLE_STATUS_CODES:
+                    error = f"A retriable HTTP error {e.resp.status} occurred"
+                elif state and e.resp.status in (404, 410):
+                    # The saved session has expired, start over
+                    print("Upload session expired, restarting upload")
+                    os.remove(state_file)
+                    state = None
+                    request = create_request()
+                    continue
+                else:
+                    print(f"An HTTP error {e.resp.status} occurred:\n{e.content}")
+                    return False
+            except RETRIABLE_EXCEPTIONS as e:
+                error = f"A retriable error occurred: {e}"
+
+            if error is not None:
+                retry += 1
+                if retry > max_retries:
+                    print(f"{error}, giving up after {max_retries} retries")
+                    return False
+
+                sleep_seconds = random.random() * 2**retry
+                print(f"{error}, retrying in {sleep_seconds:.1f} seconds")
+                time.sleep(sleep_seconds)
+
+        if os.path.exists(state_file):
+            os.remove(state_file)
+
         print(f"Video uploaded successfully! Video ID: {response['id']}")
+        record_uploaded_title(response["id"], config["title"])
         return True
-    except googleapiclient.errors.HttpError as e:
-        print(f"An HTTP error {e.resp.status} occurred:\n{e.content}")
-    return False
+
+
+def load_upload_state(state_file, file_path):
+    if not os.path.exists(state_file):
+        return None
+
+    with open(state_file, "r") as file:
+        state = json.load(file)
+
+    # Only resume if the video hasn't changed since the session started
+    stat = os.stat(file_path)
+    if state["size"] != stat.st_size or state["mtime"] != stat.st_mtime:
+        os.remove(state_file)
+        return None
+
+    return state
+
+
+def save_upload_state(state_file, file_path, resumable_uri):
+    stat = os.stat(file_path)
+    state = {
+        "resumable_uri": resumable_uri,
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+    }
+    with open(state_file, "w") as file:
+        json.dump(state, file)
+    return state
+
+
+def upload_videos(config_files, max_concurrent=MAX_CONCURRENT_UPLOADS, **kwargs):
+    credentials = get_credentials()
+
+    def upload_one(config_file):
+        # Each thread needs its own service, httplib2 isn't thread-safe
+        youtube = get_authenticated_service(credentials)
+        return upload_video(youtube, load_config(config_file), **kwargs)
+
+    with ThreadPoolExecutor(max_workers=max_concurrent) as executor:
+        return list(executor.map(upload_one, config_files))
 
 
 def get_uploads_playlist_id(youtube):
@@ -81,19 +212,107 @@ def get_uploads_playlist_id(youtube):
     ]
 
 
-def update_video_descriptions(youtube, disclaimer, batch_size=50):
+def load_titles_index():
+    if os.path.exists(TITLES_INDEX_FILE):
+        with open(TITLES_INDEX_FILE, "r") as file:
+            return json.load(file)
+    return {"videos": {}, "latest_video_id": None, "synced_at": 0}
+
+
+def save_titles_index(index):
+    temp_file = f"{TITLES_INDEX_FILE}.tmp"
+    with open(temp_file, "w") as file:
+        json.dump(index, file, ensure_ascii=False)
+    os.replace(temp_file, TITLES_INDEX_FILE)
+
+
+def record_uploaded_title(video_id, title):
+    with _titles_index_lock:
+        index = load_titles_index()
+        index["videos"][video_id] = title
+        save_titles_index(index)
+
+
+def sync_titles_index(youtube, force=False):
+    with _titles_index_lock:
+        index = load_titles_index()
+        if not force and time.time() - index["synced_at"] < TITLES_SYNC_INTERVAL:
+            return index
+
+        uploads_playlist_id = get_uploads_playlist_id(youtube)
+        if not uploads_playlist_id:
+            return index
+
+        # The uploads playlist is newest first, so stop paging as soon as we
+        # reach the newest video seen by the previous sync
+        new_videos = []
+        next_page_token = None
+        reached_known = False
+        while not reached_known:
+            playlist_items_response = (
+                youtube.playlistItems()
+                .list(
+                    part="snippet",
+                    playlistId=uploads_playlist_id,
+                    maxResults=50,
+                    pageToken=next_page_token,
+                )
+                .execute()
+            )
+
+            for item in playlist_items_response["items"]:
+                video_id = item["snippet"]["resourceId"]["videoId"]
+                if video_id == index["latest_video_id"]:
+                    reached_known = True
+                    break
+                new_videos.append((video_id, item["snippet"]["title"]))
+
+            next_page_token = playlist_items_response.get("nextPageToken")
+            if not next_page_token:
+                break
+
+        for video_id, title in new_videos:
+            index["videos"][video_id] = title
+        if new_videos:
+            index["latest_video_id"] = new_videos[0][0]
+        index["synced_at"] = time.time()
+
+        save_titles_index(index)
+        print(f"Synced {len(new_videos)} new uploaded titles")
+
+        return index
+
+
+def load_descriptions_index():
+    if os.path.exists(DESCRIPTIONS_INDEX_FILE):
+        with open(DESCRIPTIONS_INDEX_FILE, "r") as file:
+            return json.load(file)
+    return {}
+
+
+def save_descriptions_index(index):
+    temp_file = f"{DESCRIPTIONS_INDEX_FILE}.tmp"
+    with open(temp_file, "w") as file:
+        json.dump(index, file)
+    os.replace(temp_file, DESCRIPTIONS_INDEX_FILE)
+
+
+def update_video_descriptions(youtube, disclaimer, batch_size=50, dry_run=False):
+    quota = {"channels.list": 1}
     uploads_playlist_id = get_uploads_playlist_id(youtube)
     if not uploads_playlist_id:
         return
 
-    page_token = None
-    updated_count = 0
-    total_count = 0
+    # Video IDs (and their ETags) whose description already has the disclaimer
+    processed = load_descriptions_index()
+
+    # The next playlist page is fetched on its own connection while the
+    # current batch is executing
+    prefetch_youtube = get_authenticated_service()
 
-    while True:
-        # Fetch video IDs from the uploads playlist
-        playlist_items_response = (
-            youtube.playlistItems()
+    def fetch_page(page_token):
+        return (
+            prefetch_youtube.playlistItems()
             .list(
                 part="contentDetails",
                 playlistId=uploads_playlist_id,
@@ -103,50 +322,99 @@ def update_video_descriptions(youtube, disclaimer, batch_size=50):
             .execute()
         )
 
-        video_ids = [
-            item["contentDetails"]["videoId"]
-            for item in playlist_items_response["items"]
-        ]
-        total_count += len(video_ids)
+    def record_update(request_id, response, exception):
+        if exception is not None:
+            print(f"Failed to update video {request_id}: {exception}")
+            return
+        processed[response["id"]] = response["etag"]
 
-        if not video_ids:
-            break
+    updated_count = 0
+    skipped_count = 0
+    total_count = 0
 
-        # Fetch video details
-        videos_response = (
-            youtube.videos().list(part="snippet", id=",".join(video_ids)).execute()
-        )
+    with ThreadPoolExecutor(max_workers=1) as prefetcher:
+        next_page = prefetcher.submit(fetch_page, None)
+
+        while next_page is not None:
+            playlist_items_response = next_page.result()
+            quota["playlistItems.list"] = quota.get("playlistItems.list", 0) + 1
+
+            page_token = playlist_items_response.get("nextPageToken")
+            next_page = None
+            if page_token:
+                next_page = prefetcher.submit(fetch_page, page_token)
+
+            video_ids = [
+                item["contentDetails"]["videoId"]
+                for item in playlist_items_response["items"]
+            ]
+            total_count += len(video_ids)
+
+            # Videos handled by an earlier run don't need their snippet fetched
+            pending_ids = [
+                video_id for video_id in video_ids if video_id not in processed
+            ]
+            skipped_count += len(video_ids) - len(pending_ids)
+            if not pending_ids:
+                continue
+
+            # Fetch video details
+            videos_response = (
+                youtube.videos()
+                .list(part="snippet", id=",".join(pending_ids))
+                .execute()
+            )
+            quota["videos.list"] = quota.get("videos.list", 0) + 1
 
-        # Prepare batch request
-        batch = youtube.new_batch_http_request()
-        batch_count = 0
+            # Prepare batch request
+            batch = youtube.new_batch_http_request(callback=record_update)
+            batch_count = 0
+
+            for video in videos_response["items"]:
+                snippet = video["snippet"]
+                current_description = snippet["description"]
+                if current_description.endswith(disclaimer):
+                    processed[video["id"]] = video["etag"]
+                    continue
 
-        for video in videos_response["items"]:
-            snippet = video["snippet"]
-            current_description = snippet["description"]
-            if not current_description.endswith(disclaimer):
                 snippet["description"] = current_description + "\n\n" + disclaimer
+                batch_count += 1
+                updated_count += 1
+
+                if dry_run:
+                    print(
+                        f"Would update video: {snippet['title']} (ID: {video['id']})"
+                    )
+                    continue
+
                 batch.add(
                     youtube.videos().update(
                         part="snippet", body={"id": video["id"], "snippet": snippet}
-                    )
+                    ),
+                    request_id=video["id"],
                 )
-                batch_count += 1
-                updated_count += 1
                 print(
                     f"Updating video: {video['snippet']['title']} (ID: {video['id']})"
                 )
 
-        # Execute batch request if there are updates
-        if batch_count > 0:
-            batch.execute()
-            print(f"Updated {batch_count} video descriptions in this batch.")
+            # Execute batch request if there are updates
+            if batch_count > 0 and not dry_run:
+                batch.execute()
+                quota["videos.update"] = quota.get("videos.update", 0) + batch_count
+                print(f"Updated {batch_count} video descriptions in this batch.")
 
-        page_token = playlist_items_response.get("nextPageToken")
-        if not page_token:
-            break
+            if not dry_run:
+                save_descriptions_index(processed)
+
+    action = "Would update" if dry_run else "Updated"
+    print(
+        f"{action} {updated_count} out of {total_count} video descriptions "
+        f"({skipped_count} already processed)."
+    )
 
-    print(f"Updated {updated_count} out of {total_count} video descriptions.")
+    units = sum(QUOTA_COSTS[method] * calls for method, calls in quota.items())
+    calls = ", ".join(f"{method}: {calls}" for method, calls in quota.items())
+    print(f"Quota used: {units} units ({calls})")
 
 
 def main():
@@ -154,7 +422,10 @@ def main():
         description="Upload a video to YouTube or update video descriptions."
     )
     parser.add_argument(
-        "--config_file", help="Path to the JSON configuration file", required=False
+        "--config_file",
+        nargs="+",
+        help="Path to one or more JSON configuration files",
+        required=False,
     )
     parser.add_argument(
         "--update_descriptions",
@@ -167,15 +438,41 @@ def main():
         default=50,
         help="Batch size for updating descriptions (max 50)",
     )
+    parser.add_argument(
+        "--chunk_size_mb",
+        type=int,
+        default=UPLOAD_CHUNK_SIZE // (1024 * 1024),
+        help="Size of each resumable upload chunk in MB",
+    )
+    parser.add_argument(
+        "--max_concurrent",
+        type=int,
+        default=MAX_CONCURRENT_UPLOADS,
+        help="Maximum number of videos to upload at the same time",
+    )
+    parser.add_argument(
+        "--dry_run",
+        action="store_true",
+        help="Report which descriptions would be updated without changing them",
+    )
     args = parser.parse_args()
 
     youtube = get_authenticated_service()
 
     if args.update_descriptions:
-        update_video_descriptions(youtube, constants.DISCLAIMER, args.batch_size)
+        update_video_descriptions(
+            youtube, constants.DISCLAIMER, args.batch_size, args.dry_run
+        )
     elif args.config_file:
-        config = load_config(args.config_file)
-        upload_video(youtube, config)
+        chunksize = args.chunk_size_mb * 1024 * 1024
+        if len(args.config_file) == 1:
+            config = load_config(args.config_file[0])
+            upload_video(youtube, config, chunksize=chunksize)
+        else:
+            results = upload_videos(
+                args.config_file, args.max_concurrent, chunksize=chunksize
+            )
+            print(f"Uploaded {sum(results)} out of {len(results)} videos.")
     else:
         print("Please specify either --config_file or --update_descriptions")
 
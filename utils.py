@@ -1,60 +1,82 @@
+import hashlib
 import json
 import os
 import random
-import subprocess
+from collections import deque
 
 import dotenv
-from openai import OpenAI
 
 import constants
+import llm_cache
+import metrics
 import upload
 
 dotenv.load_dotenv()
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
 
 def get_uploaded_video_titles(youtube):
-    uploads_playlist_id = upload.get_uploads_playlist_id(youtube)
-    if not uploads_playlist_id:
-        return []
-
-    titles = []
-    next_page_token = None
-
-    while True:
-        playlist_items_response = (
-            youtube.playlistItems()
-            .list(
-                part="snippet",
-                playlistId=uploads_playlist_id,
-                maxResults=50,
-                pageToken=next_page_token,
-            )
-            .execute()
-        )
-
-        for item in playlist_items_response["items"]:
-            titles.append(item["snippet"]["title"])
-
-        next_page_token = playlist_items_response.get("nextPageToken")
-        if not next_page_token:
-            break
-
-    return titles
+    index = upload.sync_titles_index(youtube)
+    return list(index["videos"].values())
+
+
+def build_matcher(patterns):
+    # Aho-Corasick automaton: goto transitions, failure links and the
+    # patterns that end at each state
+    transitions = [{}]
+    failure = [0]
+    outputs = [set()]
+
+    for pattern in patterns:
+        state = 0
+        for char in pattern.lower():
+            if char not in transitions[state]:
+                transitions.append({})
+                failure.append(0)
+                outputs.append(set())
+                transitions[state][char] = len(transitions) - 1
+            state = transitions[state][char]
+        outputs[state].add(pattern)
+
+    queue = deque(transitions[0].values())
+    while queue:
+        state = queue.popleft()
+        for char, next_state in transitions[state].items():
+            queue.append(next_state)
+            fallback = failure[state]
+            while fallback and char not in transitions[fallback]:
+                fallback = failure[fallback]
+            failure[next_state] = transitions[fallback].get(char, 0)
+            if failure[next_state] == next_state:
+                failure[next_state] = 0
+            outputs[next_state] |= outputs[failure[next_state]]
+
+    return transitions, failure, outputs
+
+
+def find_matches(matcher, text):
+    transitions, failure, outputs = matcher
+
+    matches = set()
+    state = 0
+    for char in text.lower():
+        while state and char not in transitions[state]:
+            state = failure[state]
+        state = transitions[state].get(char, 0)
+        matches |= outputs[state]
+
+    return matches
 
 
 def filter_animals(animals_file_path, youtube):
     with open(animals_file_path, "r") as file:
-        all_animals = set(file.read().splitlines())
+        # Blank lines would otherwise become an empty animal name
+        all_animals = {animal for animal in file.read().splitlines() if animal}
 
     uploaded_titles = get_uploaded_video_titles(youtube)
-    used_animals = set()
 
-    for title in uploaded_titles:
-        title_lower = title.lower()
-        for animal in all_animals:
-            if animal.lower() in title_lower:
-                used_animals.add(animal)
+    # One pass over all titles finds every animal mentioned in any of them
+    matcher = build_matcher(all_animals)
+    used_animals = find_matches(matcher, "\n".join(uploaded_titles))
 
     return list(all_animals - used_animals)
 
@@ -68,6 +90,12 @@ def pick_random_animal(file_path, youtube):
     return random.choice(filtered_animals)
 
 
+def pick_random_animals(file_path, youtube, count, exclude=()):
+    # Distinct animals, so concurrent jobs never make the same short
+    filtered_animals = sorted(set(filter_animals(file_path, youtube)) - set(exclude))
+    return random.sample(filtered_animals, min(count, len(filtered_animals)))
+
+
 def normalize_sound(basedir, input_file, output_file):
     input_file_path = os.path.join(basedir, input_file)
     output_file_path = os.path.join(basedir, output_file)
@@ -84,50 +112,66 @@ def normalize_sound(basedir, input_file, output_file):
         output_file_path,
     ]
 
-    subprocess.run(ffmpeg_command, capture_output=True)
+    metrics.run(ffmpeg_command, name="ffmpeg.loudnorm", capture_output=True)
 
     os.remove(input_file_path)
 
 
-def generate_upload_config(basedir):
+def parse_upload_config(response_text):
+    # Use json.loads() to parse the response into a Python dict
+    config = json.loads(response_text)
+    if not isinstance(config, dict) or not {"title", "description"} <= config.keys():
+        raise ValueError(f"Expected a title and description, got: {response_text}")
+    return config
+
+
+def generate_upload_config(basedir, use_cache=True):
+    config_file = os.path.join(basedir, "upload_config.json")
 
     with open(os.path.join(basedir, "response.txt"), "r") as file:
         script = file.read()
 
-    response = client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
-            {
-                "role": "system",
-                "content": "You are a helpful assistant that generates catchy YouTube short titles and descriptions.",
-            },
-            {
-                "role": "user",
-                "content": f"Please generate a catchy title and description for the following youtube short script: {script}. "
-                "Include relevant emojis at the end of the title and description. "
-                "Return the title and description as valid JSON.",
-            },
-        ],
-        response_format={"type": "json_object"},
-    )
-
-    response_text = response.choices[0].message.content
-
-    # Use json.loads() to parse the response into a Python dict
-    try:
-        config = json.loads(response_text)
-    except json.JSONDecodeError as e:
-        print("Failed to parse JSON:", e)
-        # You may need to clean or correct the response to extract valid JSON
+    # The title and description only depend on the script
+    script_hash = hashlib.sha256(script.encode("utf-8")).hexdigest()
+    if use_cache and os.path.exists(config_file):
+        with open(config_file) as f:
+            if json.load(f).get("script_hash") == script_hash:
+                print("Reusing existing upload config")
+                return config_file
+
+    with metrics.span("llm.upload_config"):
+        try:
+            config = llm_cache.complete(
+                "gpt-4o",
+                [
+                    {
+                        "role": "system",
+                        "content": "You are a helpful assistant that generates catchy YouTube short titles and descriptions.",
+                    },
+                    {
+                        "role": "user",
+                        "content": f"Please generate a catchy title and description for the following youtube short script: {script}. "
+                        "Include relevant emojis at the end of the title and description. "
+                        "Return the title and description as valid JSON.",
+                    },
+                ],
+                response_format={"type": "json_object"},
+                use_cache=use_cache,
+                parse=parse_upload_config,
+            )
+        except ValueError as e:
+            print("Failed to parse upload config:", e)
+            raise
 
     config["file_path"] = os.path.join(basedir, "normalized_short.avi")
     config["category"] = "15"
     config["privacy_status"] = "private"
     config["description"] = f"{config['description']}\n\n{constants.DISCLAIMER}"
+    config["script_hash"] = script_hash
 
     print(config)
 
-    with open(os.path.join(basedir, "upload_config.json"), "w") as f:
+    with open(config_file, "w") as f:
         json.dump(config, f)
 
-    return os.path.join(basedir, "upload_config.json")
+    return config_file
@@ -1,41 +1,87 @@
-from pydub import AudioSegment
 import subprocess
 import numpy as np
 import captacity
 import json
+import hashlib
 import math
+import multiprocessing
+import time
 import cv2
 import os
-
-def get_audio_duration(audio_file):
-    return len(AudioSegment.from_file(audio_file))
-
-def add_narration_to_video(narrations, input_video, output_dir, output_file):
-    full_narration = AudioSegment.empty()
-
+import shutil
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import audio_index
+import metrics
+import transcriber
+
+def write_narration_list(narrations, output_dir):
+    list_file = os.path.join(output_dir, "narrations.txt")
+    with open(list_file, "w") as f:
+        for i, _ in enumerate(narrations):
+            audio = os.path.join(output_dir, "narrations", f"narration_{i+1}.mp3")
+            f.write(f"file '{os.path.abspath(audio)}'\n")
+    return list_file
+
+def get_narration_audio_args(narrations, output_dir, first_input, normalize):
+    # Returns the ffmpeg input arguments, the output arguments that produce
+    # the narration track and any temporary files to remove afterwards
+    if not normalize:
+        # ffmpeg reads the clips one after another through the concat demuxer
+        narration_list = write_narration_list(narrations, output_dir)
+        input_args = ['-f', 'concat', '-safe', '0', '-i', narration_list]
+        return input_args, ['-map', f"{first_input}:a"], [narration_list]
+
+    # Second pass of two-pass loudnorm per clip, using the measurements
+    # cached in the audio manifest, then the clips are concatenated
+    index = audio_index.load(output_dir)
+
+    input_args = []
+    filters = []
+    labels = ""
     for i, _ in enumerate(narrations):
         audio = os.path.join(output_dir, "narrations", f"narration_{i+1}.mp3")
-        full_narration += AudioSegment.from_file(audio)
-
-    temp_narration = os.path.join(output_dir, "narration.mp3")
-    full_narration.export(temp_narration, format="mp3")
+        loudness = index.loudness(audio)
+
+        input_args += ['-i', audio]
+        filters.append(
+            f"[{first_input + i}:a]loudnorm={audio_index.LOUDNORM_TARGET}"
+            f":measured_I={loudness['input_i']}"
+            f":measured_TP={loudness['input_tp']}"
+            f":measured_LRA={loudness['input_lra']}"
+            f":measured_thresh={loudness['input_thresh']}"
+            f":offset={loudness['target_offset']}"
+            f":linear=true,aresample={index.sample_rate(audio)}[n{i}]"
+        )
+        labels += f"[n{i}]"
+    filters.append(f"{labels}concat=n={len(narrations)}:v=0:a=1[a]")
+
+    return input_args, ['-filter_complex', ';'.join(filters), '-map', '[a]'], []
+
+def add_narration_to_video(narrations, input_video, output_dir, output_file, normalize=False):
+    # The narration is built by ffmpeg straight from the clip files and
+    # encoded once to AAC, so nothing is decoded in Python
+    input_args, audio_args, temp_files = get_narration_audio_args(narrations, output_dir, 1, normalize)
 
     ffmpeg_command = [
         'ffmpeg',
         '-y',
         '-i', input_video,
-        '-i', temp_narration,
+        *input_args,
         '-map', '0:v',   # Map video from the first input
-        '-map', '1:a',   # Map audio from the second input
+        *audio_args,     # Map the narration track
         '-c:v', 'copy',  # Copy video codec
         '-c:a', 'aac',   # AAC audio codec
         '-strict', 'experimental',
         os.path.join(output_dir, output_file)
     ]
 
-    subprocess.run(ffmpeg_command, capture_output=True)
+    metrics.run(ffmpeg_command, name="ffmpeg.mux", capture_output=True)
 
-    os.remove(temp_narration)
+    for temp_file in temp_files:
+        os.remove(temp_file)
 
 def resize_image(image, width, height):
     # Calculate the aspect ratio of the original image
@@ -52,106 +98,451 @@ def resize_image(image, width, height):
     # Resize the image to the new dimensions without distorting it
     return cv2.resize(image, (new_width, new_height))
 
-def create(narrations, output_dir, output_filename, caption_settings: dict|None = None):
-    if caption_settings is None:
-        caption_settings = {}
+def get_image_count(output_dir):
+    return len(
+        [f for f in os.listdir(os.path.join(output_dir, "images")) if f.endswith(".webp")]
+    )
 
-    # Define the dimensions and frame rate of the video
-    width, height = 1080, 1920  # Change as needed for your vertical video
-    frame_rate = 30  # Adjust as needed
+def get_hold_frames(output_dir, image_count, frame_rate, fade_time):
+    # Number of frames each image is shown before fading into the next one
+    index = audio_index.load(output_dir)
 
-    fade_time = 1000
+    hold_frames = []
+    for i in range(image_count):
+        narration = os.path.join(output_dir, "narrations", f"narration_{i+1}.mp3")
+        duration = index.duration_ms(narration)
+
+        if i > 0:
+            duration -= fade_time
+
+        if i == image_count-1:
+            duration -= fade_time
+
+        hold_frames.append(max(0, math.floor(duration/1000*frame_rate)))
+
+    return hold_frames
+
+def get_scene_images(output_dir, i, image_count):
+    # Scene i holds image i and fades into the next one, wrapping to image_1
+    image1 = os.path.join(output_dir, "images", f"image_{i+1}.webp")
+    image2 = os.path.join(output_dir, "images", f"image_{i+2 if i+1 < image_count else 1}.webp")
+    return image1, image2
+
+def prepare_frame(image_path, width, height):
+    # Decode, resize and letterbox an image into a full output frame
+    image = resize_image(cv2.imread(image_path), width, height)
+    frame = np.zeros((height, width, 3), dtype=np.uint8)
+    frame[:image.shape[0], :image.shape[1]] = image
+    return frame
+
+def get_frame_path(image_path):
+    return os.path.splitext(image_path)[0] + ".npy"
+
+def uses_frames(backend, single_pass=False):
+    # The ffmpeg filter graph reads the images itself, every other path
+    # goes through FrameProvider
+    return single_pass or backend != "ffmpeg"
+
+def is_ingested(image_path):
+    # The frame carries its image's mtime, a newer mtime isn't enough since
+    # images fetched from the asset cache keep the cache entry's older one
+    frame_path = get_frame_path(image_path)
+    return os.path.exists(frame_path) and os.stat(frame_path).st_mtime_ns == os.stat(image_path).st_mtime_ns
+
+def ingest_image(image_path, width, height):
+    # Store the letterboxed frame next to the image so renders can map it
+    # instead of decoding and resizing the image again
+    frame_path = get_frame_path(image_path)
+    temp_path = f"{frame_path}.tmp"
+    stat = os.stat(image_path)
+    with open(temp_path, "wb") as f:
+        np.save(f, prepare_frame(image_path, width, height))
+    os.utime(temp_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    os.replace(temp_path, frame_path)
+
+def ingest_images(output_dir, width=1080, height=1920):
+    images_dir = os.path.join(output_dir, "images")
+    for f in sorted(os.listdir(images_dir)):
+        image_path = os.path.join(images_dir, f)
+        if f.endswith(".webp") and not is_ingested(image_path):
+            ingest_image(image_path, width, height)
+
+def load_frame(image_path, width, height):
+    if is_ingested(image_path):
+        frame = np.load(get_frame_path(image_path), mmap_mode="r")
+        if frame.shape == (height, width, 3):
+            return frame
+
+    return prepare_frame(image_path, width, height)
+
+class FrameProvider:
+    def __init__(self, width, height, capacity=2):
+        self.width = width
+        self.height = height
+        self.capacity = capacity
+        self.frames = OrderedDict()
+
+        # Fades are blended into this buffer instead of a new frame each time
+        self.canvas = np.zeros((height, width, 3), dtype=np.uint8)
+
+    def get(self, image_path):
+        if image_path in self.frames:
+            self.frames.move_to_end(image_path)
+            return self.frames[image_path]
+
+        frame = load_frame(image_path, self.width, self.height)
+        self.frames[image_path] = frame
+        if len(self.frames) > self.capacity:
+            self.frames.popitem(last=False)
+
+        return frame
+
+def generate_scene_frames(provider, image1_path, image2_path, hold_frames, frame_rate, fade_time):
+    # Yielded frames are reused buffers, consumers must not modify or keep them
+    frame1 = provider.get(image1_path)
+    frame2 = provider.get(image2_path)
+
+    for _ in range(hold_frames):
+        yield frame1
+
+    for alpha in np.linspace(0, 1, math.floor(fade_time/1000*frame_rate)):
+        cv2.addWeighted(frame1, 1 - alpha, frame2, alpha, 0, dst=provider.canvas)
+
+        yield provider.canvas
+
+def generate_frames(output_dir, width, height, frame_rate, fade_time):
+    image_count = get_image_count(output_dir)
+    hold_frames = get_hold_frames(output_dir, image_count, frame_rate, fade_time)
+
+    # Each image is prepared once when its scene starts and stays resident
+    # for the fade out of the previous scene
+    provider = FrameProvider(width, height)
+
+    # Load images and perform the transition effect
+    for i in range(image_count):
+        image1, image2 = get_scene_images(output_dir, i, image_count)
+        yield from generate_scene_frames(provider, image1, image2, hold_frames[i], frame_rate, fade_time)
 
+def write_frames(frames, output_file, width, height, frame_rate):
     # Create a VideoWriter object to save the video
     fourcc = cv2.VideoWriter_fourcc(*'XVID')  # You can change the codec as needed
-    temp_video = os.path.join(output_dir, "temp_video.avi")  # Output video file name
-    out = cv2.VideoWriter(temp_video, fourcc, frame_rate, (width, height))
+    out = cv2.VideoWriter(output_file, fourcc, frame_rate, (width, height))
 
-    # List of image file paths to use in the video
-    image_paths = os.listdir(os.path.join(output_dir, "images"))  # Replace with your image paths
-    image_count = len(image_paths)
+    for frame in frames:
+        out.write(frame)
 
-    # Load images and perform the transition effect
+    # Release the VideoWriter and close the window if any
+    out.release()
+    cv2.destroyAllWindows()
+
+def render_with_opencv(output_dir, output_file, width, height, frame_rate, fade_time, workers=None):
+    if workers and workers > 1:
+        render_parallel(output_dir, output_file, width, height, frame_rate, fade_time, workers)
+        return
+
+    frames = generate_frames(output_dir, width, height, frame_rate, fade_time)
+    write_frames(frames, output_file, width, height, frame_rate)
+
+def render_scene(image1_path, image2_path, hold_frames, output_file, width, height, frame_rate, fade_time, provider=None):
+    if provider is None:
+        provider = FrameProvider(width, height)
+
+    frames = generate_scene_frames(provider, image1_path, image2_path, hold_frames, frame_rate, fade_time)
+    write_frames(frames, output_file, width, height, frame_rate)
+
+def render_scenes(scenes, width, height, frame_rate, fade_time, workers=None):
+    # Each scene is (image1, image2, hold frames, output file)
+    if not workers or workers < 2 or len(scenes) < 2:
+        provider = FrameProvider(width, height)
+        for image1, image2, hold_frames, output_file in scenes:
+            with metrics.span("render.scene", file=os.path.basename(output_file)):
+                render_scene(image1, image2, hold_frames, output_file, width, height, frame_rate, fade_time, provider)
+        return
+
+    # Scenes are independent, so each worker renders and encodes its own.
+    # Workers are spawned, the caller may have other threads mid-request
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=min(workers, len(scenes)), mp_context=context) as executor:
+        futures = [
+            executor.submit(render_scene, image1, image2, hold_frames, output_file, width, height, frame_rate, fade_time)
+            for image1, image2, hold_frames, output_file in scenes
+        ]
+        for future in futures:
+            future.result()
+
+def render_parallel(output_dir, output_file, width, height, frame_rate, fade_time, workers):
+    image_count = get_image_count(output_dir)
+    hold_frames = get_hold_frames(output_dir, image_count, frame_rate, fade_time)
+
+    segments_dir = os.path.join(output_dir, "segments")
+    if not os.path.exists(segments_dir):
+        os.makedirs(segments_dir)
+
+    scenes = []
     for i in range(image_count):
-        image1 = cv2.imread(os.path.join(output_dir, "images", f"image_{i+1}.webp"))
+        image1, image2 = get_scene_images(output_dir, i, image_count)
+        scenes.append((image1, image2, hold_frames[i], os.path.join(segments_dir, f"scene_{i+1}.avi")))
 
-        if i+1 < image_count:
-            image2 = cv2.imread(os.path.join(output_dir, "images", f"image_{i+2}.webp"))
-        else:
-            image2 = cv2.imread(os.path.join(output_dir, "images", f"image_1.webp"))
+    render_scenes(scenes, width, height, frame_rate, fade_time, workers)
+    concat_videos([scene[3] for scene in scenes], output_file)
 
-        image1 = resize_image(image1, width, height)
-        image2 = resize_image(image2, width, height)
+    shutil.rmtree(segments_dir)
 
-        narration = os.path.join(output_dir, "narrations", f"narration_{i+1}.mp3")
-        duration = get_audio_duration(narration)
+def get_scene_key(image1_path, image2_path, hold_frames, width, height, frame_rate, fade_time):
+    digest = hashlib.sha256()
+    for path in (image1_path, image2_path):
+        with open(path, "rb") as f:
+            digest.update(hashlib.sha256(f.read()).digest())
+    digest.update(json.dumps([hold_frames, width, height, frame_rate, fade_time]).encode())
+    return digest.hexdigest()[:16]
+
+def concat_videos(input_files, output_file):
+    list_file = f"{output_file}.txt"
+    with open(list_file, "w") as f:
+        for input_file in input_files:
+            f.write(f"file '{os.path.abspath(input_file)}'\n")
+
+    ffmpeg_command = [
+        'ffmpeg',
+        '-y',
+        '-f', 'concat',
+        '-safe', '0',
+        '-i', list_file,
+        '-c', 'copy',
+        output_file,
+    ]
+
+    metrics.run(ffmpeg_command, name="ffmpeg.concat", capture_output=True, check=True)
+
+    os.remove(list_file)
+
+def render_chunked(output_dir, output_file, width, height, frame_rate, fade_time, only_scene=None, workers=None):
+    image_count = get_image_count(output_dir)
+    if only_scene is not None and not 1 <= only_scene <= image_count:
+        raise ValueError(f"only_scene must be between 1 and {image_count}, got {only_scene}")
+    hold_frames = get_hold_frames(output_dir, image_count, frame_rate, fade_time)
+
+    chunks_dir = os.path.join(output_dir, "chunks")
+    if not os.path.exists(chunks_dir):
+        os.makedirs(chunks_dir)
+
+    chunks = []
+    scenes = []
+    for i in range(image_count):
+        image1, image2 = get_scene_images(output_dir, i, image_count)
+        key = get_scene_key(image1, image2, hold_frames[i], width, height, frame_rate, fade_time)
+        chunk = os.path.join(chunks_dir, f"scene_{i+1}_{key}.avi")
+        previous = sorted(
+            (os.path.join(chunks_dir, f) for f in os.listdir(chunks_dir) if f.startswith(f"scene_{i+1}_")),
+            key=os.path.getmtime,
+        )
+
+        # With only_scene set, every other scene keeps whatever chunk it has
+        if only_scene is not None and i+1 != only_scene and previous:
+            chunks.append(previous[-1])
+            continue
+
+        if only_scene == i+1 or not os.path.exists(chunk):
+            print(f"Rendering scene {i+1}...")
+            scenes.append((image1, image2, hold_frames[i], chunk))
 
+            for stale in previous:
+                if stale != chunk:
+                    os.remove(stale)
+
+        chunks.append(chunk)
+
+    render_scenes(scenes, width, height, frame_rate, fade_time, workers)
+
+    concat_videos(chunks, output_file)
+
+def render_with_ffmpeg(output_dir, output_file, width, height, frame_rate, fade_time):
+    image_count = get_image_count(output_dir)
+    hold_frames = get_hold_frames(output_dir, image_count, frame_rate, fade_time)
+    fade = math.floor(fade_time/1000*frame_rate) / frame_rate
+
+    # Each still is looped for its hold plus the fades it takes part in,
+    # and the last image fades back into image_1 like the OpenCV path
+    clips = []
+    for i in range(image_count):
+        length = hold_frames[i] / frame_rate + fade
         if i > 0:
-            duration -= fade_time
+            length += fade
+        clips.append((f"image_{i+1}.webp", length))
+    clips.append(("image_1.webp", fade))
+
+    ffmpeg_command = ['ffmpeg', '-y']
+    filters = []
+    for k, (image, length) in enumerate(clips):
+        ffmpeg_command += [
+            '-loop', '1',
+            '-framerate', str(frame_rate),
+            '-t', f"{length:.6f}",
+            '-i', os.path.join(output_dir, "images", image),
+        ]
+        # Fit inside the frame and pin to the top, same as resize_image
+        filters.append(
+            f"[{k}:v]scale={width}:{height}:force_original_aspect_ratio=decrease,"
+            f"pad={width}:{height}:0:0:black,setsar=1,fps={frame_rate},format=yuv420p[v{k}]"
+        )
+
+    last = "v0"
+    offset = clips[0][1]
+    for k in range(1, len(clips)):
+        filters.append(
+            f"[{last}][v{k}]xfade=transition=fade:duration={fade:.6f}:offset={offset - fade:.6f}[x{k}]"
+        )
+        last = f"x{k}"
+        offset += clips[k][1] - fade
+
+    ffmpeg_command += [
+        '-filter_complex', ';'.join(filters),
+        '-map', f"[{last}]",
+        '-r', str(frame_rate),
+        '-c:v', 'mpeg4',
+        '-vtag', 'XVID',
+        '-q:v', '2',
+        output_file,
+    ]
 
-        if i == image_count-1:
-            duration -= fade_time
+    metrics.run(ffmpeg_command, name="ffmpeg.render", capture_output=True, check=True)
 
-        for _ in range(math.floor(duration/1000*30)):
-            vertical_video_frame = np.zeros((height, width, 3), dtype=np.uint8)
-            vertical_video_frame[:image1.shape[0], :] = image1
+def render_single_pass(narrations, output_dir, output_file, width, height, frame_rate, fade_time):
+    # Raw frames come in on stdin and the narration clips are normalized
+    # and concatenated by the same ffmpeg process
+    input_args, audio_args, temp_files = get_narration_audio_args(narrations, output_dir, 1, True)
 
-            out.write(vertical_video_frame)
+    ffmpeg_command = [
+        'ffmpeg',
+        '-y',
+        '-f', 'rawvideo',
+        '-pix_fmt', 'bgr24',
+        '-s', f"{width}x{height}",
+        '-r', str(frame_rate),
+        '-i', '-',
+        *input_args,
+        '-map', '0:v',
+        *audio_args,
+        # The mp4 muxer only accepts the default mp4v tag, not XVID
+        '-c:v', 'mpeg4',
+        '-q:v', '2',
+        '-pix_fmt', 'yuv420p',
+        '-c:a', 'aac',
+        output_file,
+    ]
 
-        for alpha in np.linspace(0, 1, math.floor(fade_time/1000*30)):
-            blended_image = cv2.addWeighted(image1, 1 - alpha, image2, alpha, 0)
-            vertical_video_frame = np.zeros((height, width, 3), dtype=np.uint8)
-            vertical_video_frame[:image1.shape[0], :] = blended_image
+    # stderr goes to a file, a full pipe would block ffmpeg while we write
+    with tempfile.TemporaryFile() as stderr, metrics.span("ffmpeg.single_pass", command="ffmpeg") as span:
+        process = subprocess.Popen(
+            ffmpeg_command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=stderr,
+        )
+        try:
+            for frame in generate_frames(output_dir, width, height, frame_rate, fade_time):
+                process.stdin.write(frame.data)
+        except BrokenPipeError:
+            # ffmpeg stopped reading, its exit code and message say why
+            pass
+        finally:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+            process.wait()
+            span["attributes"]["exit_code"] = process.returncode
+
+            for temp_file in temp_files:
+                os.remove(temp_file)
+
+        if process.returncode != 0:
+            stderr.seek(0)
+            message = stderr.read().decode("utf-8", errors="replace").strip()
+            raise RuntimeError(f"ffmpeg exited with code {process.returncode}: {message[-2000:]}")
+
+def create(narrations, output_dir, output_filename, caption_settings: dict|None = None, backend="opencv", single_pass=False, transcribe_processes=None, only_scene=None, render_workers=None, normalize_audio=False):
+    if caption_settings is None:
+        caption_settings = {}
 
-            out.write(vertical_video_frame)
+    # Define the dimensions and frame rate of the video
+    width, height = 1080, 1920  # Change as needed for your vertical video
+    frame_rate = 30  # Adjust as needed
 
-    # Release the VideoWriter and close the window if any
-    out.release()
-    cv2.destroyAllWindows()
+    fade_time = 1000
 
-    # Add narration audio to video
+    temp_video = os.path.join(output_dir, "temp_video.avi")  # Output video file name
     with_narration = "with_narration.mp4"
-    add_narration_to_video(narrations, temp_video, output_dir, with_narration)
-
-    # Add captions to video
     output_path = os.path.join(output_dir, output_filename)
     input_path = os.path.join(output_dir, with_narration)
-    segments = create_segments(narrations, output_dir)
-
-    captacity.add_captions(
-        video_file=input_path,
-        output_file=output_path,
-        segments=segments,
-        print_info=True,
-        **caption_settings,
-    )
+
+    start = time.perf_counter()
+
+    # Only images that are new or changed since they were last ingested
+    if uses_frames(backend, single_pass):
+        with metrics.span("ingest"):
+            ingest_images(output_dir, width, height)
+
+    if single_pass:
+        # Video, narration and loudness normalization in a single encode
+        with metrics.span("render", backend="single_pass"):
+            render_single_pass(narrations, output_dir, input_path, width, height, frame_rate, fade_time)
+    else:
+        with metrics.span("render", backend=backend):
+            if backend == "opencv":
+                render_with_opencv(output_dir, temp_video, width, height, frame_rate, fade_time, render_workers)
+            elif backend == "ffmpeg":
+                render_with_ffmpeg(output_dir, temp_video, width, height, frame_rate, fade_time)
+            elif backend == "chunked":
+                # Per-scene chunks are cached and joined with a stream copy
+                render_chunked(output_dir, temp_video, width, height, frame_rate, fade_time, only_scene, render_workers)
+            else:
+                raise ValueError(f"Unknown render backend: {backend}")
+
+        # Add narration audio to video
+        add_narration_to_video(narrations, temp_video, output_dir, with_narration, normalize_audio)
+
+    encode_time = time.perf_counter() - start
+
+    # Add captions to video
+    with metrics.span("transcribe", clips=len(narrations)):
+        segments = create_segments(narrations, output_dir, transcribe_processes)
+
+    with metrics.span("captions"):
+        captacity.add_captions(
+            video_file=input_path,
+            output_file=output_path,
+            segments=segments,
+            print_info=True,
+            **caption_settings,
+        )
+
+    if single_pass:
+        # 'python video.py <basedir> --single_pass' measures the savings
+        print(f"Single-pass encode took {encode_time:.1f}s")
+    else:
+        print(f"Render and mux took {encode_time:.1f}s")
 
     # Clean up temporary files
     os.remove(input_path)
-    os.remove(temp_video)
+    if not single_pass:
+        os.remove(temp_video)
 
-def create_segments(narrations, output_dir):
+def create_segments(narrations, output_dir, processes=None):
     segments = []
+    index = audio_index.load(output_dir)
 
-    offset = 0
-    for i, narration in enumerate(narrations):
-        audio_file = os.path.join(output_dir, "narrations", f"narration_{i+1}.mp3")
-
-        try:
-            t_segments = captacity.transcriber.transcribe_locally(
-                audio_file=audio_file,
-                prompt=narration,
-            )
-        except ImportError:
-            t_segments = captacity.transcriber.transcribe_with_api(
-                audio_file=audio_file,
-                prompt=narration,
-            )
+    clips = [
+        (os.path.join(output_dir, "narrations", f"narration_{i+1}.mp3"), narration)
+        for i, narration in enumerate(narrations)
+    ]
 
+    offset = 0
+    for (audio_file, _), t_segments in zip(clips, transcriber.transcribe_batch(clips, processes)):
         o_segments = offset_segments(t_segments, offset)
 
         segments += o_segments
-        offset += get_audio_duration(audio_file) / 1000
+        offset += index.duration_ms(audio_file) / 1000
 
     return segments
 
@@ -163,3 +554,114 @@ def offset_segments(segments: list[dict], offset: float):
             word["start"] += offset
             word["end"] += offset
     return segments
+
+def _benchmark_frames(output_dir, mode, width=1080, height=1920, frame_rate=30, fade_time=1000):
+    import resource
+
+    if mode == "per_frame":
+        # The loop FrameProvider replaced: both images of every scene are
+        # decoded and resized, and every frame gets a new canvas
+        def scene_frames(image1_path, image2_path, hold_frames):
+            image1 = resize_image(cv2.imread(image1_path), width, height)
+            image2 = resize_image(cv2.imread(image2_path), width, height)
+            for _ in range(hold_frames):
+                frame = np.zeros((height, width, 3), dtype=np.uint8)
+                frame[:image1.shape[0], :image1.shape[1]] = image1
+                yield frame
+            for alpha in np.linspace(0, 1, math.floor(fade_time/1000*frame_rate)):
+                blended = cv2.addWeighted(image1, 1 - alpha, image2, alpha, 0)
+                frame = np.zeros((height, width, 3), dtype=np.uint8)
+                frame[:blended.shape[0], :blended.shape[1]] = blended
+                yield frame
+
+        image_count = get_image_count(output_dir)
+        hold_frames = get_hold_frames(output_dir, image_count, frame_rate, fade_time)
+        frames = (
+            frame
+            for i in range(image_count)
+            for frame in scene_frames(*get_scene_images(output_dir, i, image_count), hold_frames[i])
+        )
+    else:
+        frames = generate_frames(output_dir, width, height, frame_rate, fade_time)
+
+    start = time.process_time()
+    count = sum(1 for _ in frames)
+    cpu_time = time.process_time() - start
+
+    return count, cpu_time, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def _benchmark_single_pass(output_dir, width=1080, height=1920, frame_rate=30, fade_time=1000):
+    with open(os.path.join(output_dir, "data.json")) as f:
+        narrations = [element["content"] for element in json.load(f) if element["type"] == "text"]
+
+    bench_dir = os.path.join(output_dir, "benchmark")
+    os.makedirs(bench_dir, exist_ok=True)
+    results = {}
+
+    try:
+        # The four-pass path without captions, which both paths share: render,
+        # mux the narration, then remux with loudnorm
+        temp_video = os.path.join(bench_dir, "temp_video.avi")
+        with_narration = os.path.join(bench_dir, "with_narration.mp4")
+        normalized = os.path.join(bench_dir, "normalized.mp4")
+
+        start = time.perf_counter()
+        render_with_opencv(output_dir, temp_video, width, height, frame_rate, fade_time)
+        add_narration_to_video(narrations, temp_video, output_dir, os.path.relpath(with_narration, output_dir))
+        subprocess.run([
+            'ffmpeg', '-y',
+            '-i', with_narration,
+            '-c:v', 'copy',
+            '-af', f"loudnorm={audio_index.LOUDNORM_TARGET}",
+            normalized,
+        ], capture_output=True, check=True)
+        results["multi_pass"] = (
+            time.perf_counter() - start,
+            sum(os.path.getsize(path) for path in (temp_video, with_narration, normalized)),
+        )
+
+        single = os.path.join(bench_dir, "single_pass.mp4")
+        start = time.perf_counter()
+        render_single_pass(narrations, output_dir, single, width, height, frame_rate, fade_time)
+        results["single_pass"] = (time.perf_counter() - start, os.path.getsize(single))
+    finally:
+        shutil.rmtree(bench_dir)
+
+    return results
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Compare CPU time and peak RSS of frame generation.")
+    parser.add_argument("basedir", type=str)
+    parser.add_argument(
+        "--single_pass",
+        action="store_true",
+        help="Instead compare wall time and bytes written by the single-pass and four-pass encodes",
+    )
+    args = parser.parse_args()
+
+    if args.single_pass:
+        results = _benchmark_single_pass(args.basedir)
+        for mode, (elapsed, written) in results.items():
+            print(f"{mode}: {elapsed:.1f}s, {written / 1024**2:.1f} MB written")
+        multi_time, multi_written = results["multi_pass"]
+        single_time, single_written = results["single_pass"]
+        print(
+            f"Single pass saved {multi_time - single_time:.1f}s and "
+            f"{(multi_written - single_written) / 1024**2:.1f} MB of writes"
+        )
+    else:
+        # Each mode runs in a fresh process so its peak RSS is its own
+        context = multiprocessing.get_context("spawn")
+        for mode in ("per_frame", "decode_once", "mmap"):
+            if mode == "mmap":
+                ingest_images(args.basedir)
+            elif mode == "decode_once":
+                for f in os.listdir(os.path.join(args.basedir, "images")):
+                    if f.endswith(".npy"):
+                        os.remove(os.path.join(args.basedir, "images", f))
+
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                count, cpu_time, peak_rss = executor.submit(_benchmark_frames, args.basedir, mode).result()
+            print(f"{mode}: {count} frames, {cpu_time:.2f}s CPU, peak RSS {peak_rss / 1024:.0f} MB")